@@ -7,29 +7,44 @@ endif
 let g:do_loaded = 1
 let s:existing_update_time = &updatetime
 let s:previous_command = ""
+let s:previous_inputs = []
+let s:timer = -1
+let s:job_pids = {}
+" Prefer Python 3, as Vim and Neovim are often built without Python 2
+let s:python = has("python3") ? "python3" : "python"
+let s:pyfile = has("python3") ? "py3file" : "pyfile"
 
 " Configuration vars
-let s:do_check_interval = 500
+let s:do_check_interval = 2000
+let s:do_check_interval_min = 50
+let s:do_check_budget = 50
+let s:do_max_parallel = 0
+let s:do_quickfix = 0
+let s:do_render_lines_per_check = 5000
+let s:do_follow_tail = 0
+let s:do_output_memory_lines = 50000
+let s:do_output_memory_bytes = 8388608
+let s:do_keep_finished = 50
+let s:do_keep_minutes = 0
+let s:do_keep_output_lines = 0
+let s:do_cache_dir = "~/.cache/vim-do"
+let s:do_cache_size = 52428800
+let s:do_history_file = ""
+let s:do_metrics = 0
+let s:do_backend = "auto"
+let s:do_queue_lines = 100000
+let s:do_backpressure = "pause"
+let s:do_timeout = 0
+let s:do_kill_grace = 2000
 let s:do_new_process_window_command = "new"
 let s:do_refresh_key = "<C-L>"
 let s:do_update_time = 500
 let s:do_auto_show_process_window = 1
+let s:do_use_timers = 1
 
-" Load Python script
-if filereadable($VIMRUNTIME."/plugin/python/do.py")
-  pyfile $VIMRUNTIME/plugin/do.py
-elseif filereadable($HOME."/.vim/plugin/python/do.py")
-  pyfile $HOME/.vim/plugin/python/do.py
-else
-  " when we use pathogen for instance
-  let $CUR_DIRECTORY=expand("<sfile>:p:h")
-
-  if filereadable($CUR_DIRECTORY."/python/do.py")
-    pyfile $CUR_DIRECTORY/python/do.py
-  else
-    call confirm('vdebug.vim: Unable to find do.py. Place it in either your home vim directory or in the Vim runtime directory.', 'OK')
-  endif
-endif
+" The Python script is loaded by s:init(), the first time it's needed
+let s:initialised = 0
+let s:script_directory = expand("<sfile>:p:h")
 
 ""
 " Fetch a scoped value of an option
@@ -58,6 +73,22 @@ function! do#get(option, ...)
     call do#error('Invalid or undefined option: ' . a:option)
 endfunction
 
+""
+" Fetch the values of all options, as a dictionary.
+"
+" Each option is resolved in the same way as do#get(), so that they can all
+" be loaded with a single call.
+"
+function! do#options()
+    let l:options = {}
+    for l:name in keys(s:)
+        if l:name =~# '^do_'
+            let l:options[l:name] = do#get(l:name)
+        endif
+    endfor
+    return l:options
+endfunction
+
 ""
 " Show user an error message
 "
@@ -78,8 +109,10 @@ endfunction
 function! do#ExecuteAgain()
     if empty(s:previous_command)
         call do#error("You cannot execute the previous command when no previous command exists!")
-    else
+    elseif empty(s:previous_inputs)
         call do#Execute(s:previous_command)
+    else
+        call do#ExecuteCached(s:previous_command, s:previous_inputs)
     endif
 endfunction
 
@@ -90,7 +123,10 @@ endfunction
 " function will reload them.
 "
 function! do#ReloadOptions()
-    python do_async.reload_options()
+    if !s:initialised
+        return
+    endif
+    execute s:python "do_async.reload_options()"
 endfunction
 
 ""
@@ -105,28 +141,124 @@ endfunction
 " file name.
 "
 " @param string command (optional) The command to run, defaults to &makeprg
+" @param boolean quiet (optional) Don't show the process window
+" @param number timeout (optional) Terminate the command after this many
+"   seconds, defaults to g:do_timeout
 "
 function! do#Execute(command, ...)
+    call s:init()
     if a:0 > 0
         let l:quiet = a:1
     else
         let l:quiet = 0
     end
+    let l:timeout = a:0 > 1 ? a:2 : do#get("do_timeout")
+    let l:command = a:command
+    if empty(l:command)
+        let l:command = &makeprg
+    endif
+    let l:command = s:expandCommand(l:command)
+    if empty(l:command)
+        call do#error("Supplied command is empty")
+    else
+        let s:previous_command = l:command
+        let s:previous_inputs = []
+        execute s:python 'do_async.execute(vim.eval("l:command"), int(vim.eval("l:quiet")) == 1, timeout = float(vim.eval("l:timeout")))'
+    endif
+endfunction
+
+""
+" Execute a shell command asynchronously, terminating it if it runs for too
+" long.
+"
+" @param string args The timeout in seconds, followed by the command
+"
+function! do#ExecuteWithTimeout(args)
+    let l:match = matchlist(a:args, '^\s*\(\d\+\(\.\d\+\)\=\)\s\+\(.*\)$')
+    if empty(l:match)
+        call do#error("Usage: DoTimeout <seconds> <command>")
+    else
+        call do#Execute(l:match[3], 0, l:match[1])
+    endif
+endfunction
+
+""
+" Execute a shell command asynchronously, reusing its last result if its
+" input files haven't changed.
+"
+" The result of the command (output and exit code) is stored on disk, keyed
+" on the command and the given globs. When run again, the files matching the
+" globs are compared with those from the stored run, and if none have changed
+" the stored result is shown instead of running the command.
+"
+" @param string command The command to run, defaults to &makeprg
+" @param list inputs Globs of the files that the command depends on
+"
+function! do#ExecuteCached(command, inputs)
+    call s:init()
     let l:command = a:command
     if empty(l:command)
         let l:command = &makeprg
     endif
-    let l:command = Strip(join(map(split(l:command, '\ze[<%#]'), 'expand(v:val)'), ''))
+    let l:command = s:expandCommand(l:command)
     if empty(l:command)
         call do#error("Supplied command is empty")
     else
         let s:previous_command = l:command
-python <<_EOF_
-do_async.execute(vim.eval("l:command"), int(vim.eval("l:quiet")) == 1)
-_EOF_
+        let s:previous_inputs = a:inputs
+        execute s:python 'do_async.execute_cached(vim.eval("l:command"), vim.eval("a:inputs"))'
+    endif
+endfunction
+
+""
+" Show the hit and miss counts of the result cache, and the time it saved.
+"
+" See do#ExecuteCached().
+"
+function! do#ShowCacheStats()
+    call s:init()
+    execute s:python "do_async.cache_stats()"
+endfunction
+
+
+""
+" Execute a list of shell commands asynchronously, as a batch.
+"
+" The commands are queued together and run as slots become free (see
+" g:do_max_parallel), without opening the process window. When they have
+" all finished, the time taken by the batch is reported alongside the time
+" the commands would have taken if run one at a time.
+"
+" @param list commands The commands to run
+"
+function! do#ExecuteBatch(commands)
+    call s:init()
+    let l:commands = filter(map(copy(a:commands), 's:expandCommand(v:val)'),
+                \ '!empty(v:val)')
+    if empty(l:commands)
+        call do#error("Supplied commands are empty")
+    else
+        execute s:python 'do_async.execute_batch(vim.eval("l:commands"))'
     endif
 endfunction
 
+""
+" Execute a pipeline of shell commands, with dependencies between them.
+"
+" Each stage is a dictionary with a "name", a "command" and optionally
+" "after", a list of the names of stages that must succeed before it starts.
+" Independent stages run in parallel. If a stage fails, the stages that
+" depend on it are skipped. Finished stages show their run time in the
+" command window, and the critical path is reported when the pipeline ends.
+"
+" @param list stages The pipeline stages
+"
+function! do#ExecutePipeline(stages)
+    call s:init()
+    let l:stages = map(copy(a:stages),
+                \ 'extend(copy(v:val), {"command": s:expandCommand(get(v:val, "command", ""))})')
+    execute s:python 'do_async.execute_pipeline(vim.eval("l:stages"))'
+endfunction
 
 ""
 " Execute a shell command asynchronously, from the current visually selected text.
@@ -144,9 +276,35 @@ endfunction
 " @param string file_path The path to the file to write log information
 "
 function! do#EnableLogger(file_path)
-python <<_EOF_
-do_async.enable_logger(vim.eval("a:file_path"))
-_EOF_
+    call s:init()
+    execute s:python 'do_async.enable_logger(vim.eval("a:file_path"))'
+endfunction
+
+""
+" A callback for when the stats window is closed.
+"
+" Executed automatically via an autocommand.
+"
+function! do#MarkStatsWindowAsClosed()
+    execute s:python "do_async.mark_stats_window_as_closed()"
+endfunction
+
+""
+" Show the metrics collected while g:do_metrics is enabled.
+"
+function! do#ShowStats()
+    call s:init()
+    execute s:python "do_async.show_stats()"
+endfunction
+
+""
+" Write the collected metrics to a file, as JSON.
+"
+" @param string file_path The path of the file to write
+"
+function! do#ExportStats(file_path)
+    call s:init()
+    execute s:python 'do_async.export_stats(vim.eval("a:file_path"))'
 endfunction
 
 ""
@@ -155,7 +313,8 @@ endfunction
 " The command window details currently running and finished processes.
 "
 function! do#ToggleCommandWindow()
-    python do_async.toggle_command_window()
+    call s:init()
+    execute s:python "do_async.toggle_command_window()"
 endfunction
 
 ""
@@ -164,7 +323,7 @@ endfunction
 " Executed automatically via an autocommand.
 "
 function! do#MarkCommandWindowAsClosed()
-    python do_async.mark_command_window_as_closed()
+    execute s:python "do_async.mark_command_window_as_closed()"
 endfunction
 
 ""
@@ -173,14 +332,62 @@ endfunction
 " Executed automatically via an autocommand.
 "
 function! do#MarkProcessWindowAsClosed()
-    python do_async.mark_process_window_as_closed()
+    execute s:python "do_async.mark_process_window_as_closed()"
+endfunction
+
+""
+" A callback for when the history window is closed.
+"
+" Executed automatically via an autocommand.
+"
+function! do#MarkHistoryWindowAsClosed()
+    execute s:python "do_async.mark_history_window_as_closed()"
+endfunction
+
+""
+" Show the most recent runs from the history.
+"
+" Requires g:do_history_file to be set.
+"
+" @param string a:1 (optional) Only show runs whose command contains this
+"
+function! do#ShowHistory(...)
+    call s:init()
+    let l:pattern = a:0 > 0 ? a:1 : ""
+    execute s:python 'do_async.show_history(vim.eval("l:pattern"))'
+endfunction
+
+""
+" Search the output of past runs in the history.
+"
+" Requires g:do_history_file to be set.
+"
+" @param string pattern A Python regular expression to search for
+"
+function! do#GrepHistory(pattern)
+    call s:init()
+    if empty(a:pattern)
+        call do#error("Supplied pattern is empty")
+    else
+        execute s:python 'do_async.grep_history(vim.eval("a:pattern"))'
+    endif
+endfunction
+
+""
+" Filter the output in the process window.
+"
+" @param string args: stderr, /pattern/, context <lines> or off
+"
+function! do#Filter(args)
+    call s:init()
+    execute s:python 'do_async.filter_output(vim.eval("a:args"))'
 endfunction
 
 ""
 " Trigger selection of a process in the command window.
 "
 function! do#ShowProcessFromCommandWindow()
-    python do_async.show_process_from_command_window()
+    execute s:python "do_async.show_process_from_command_window()"
 endfunction
 
 ""
@@ -204,12 +411,12 @@ function! do#AssignAutocommands()
     execute "nnoremap <silent> " . do#get("do_refresh_key") . " :call do#nop()<CR>"
     execute "inoremap <silent> " . do#get("do_refresh_key") . ' <C-O>:call do#nop()<CR>'
     augroup vim_do
-        au CursorHold * python do_async.check()
-        au CursorHoldI * python do_async.check()
-        au CursorMoved * python do_async.check()
-        au CursorMovedI * python do_async.check()
-        au FocusGained * python do_async.check()
-        au FocusLost * python do_async.check()
+        execute "au CursorHold * " . s:python . " do_async.check()"
+        execute "au CursorHoldI * " . s:python . " do_async.check()"
+        execute "au CursorMoved * " . s:python . " do_async.check()"
+        execute "au CursorMovedI * " . s:python . " do_async.check()"
+        execute "au FocusGained * " . s:python . " do_async.check()"
+        execute "au FocusLost * " . s:python . " do_async.check()"
     augroup END
     let &updatetime=do#get("do_update_time")
 endfunction
@@ -224,9 +431,113 @@ function! do#UnassignAutocommands()
     let &updatetime=s:existing_update_time
 endfunction
 
+""
+" Start a timer that checks processes for new output.
+"
+" Used instead of do#AssignAutocommands() when Vim supports timers. The
+" check returns immediately unless there is new output or a process has
+" exited, so nothing is done while processes are quiet. The check starts the
+" next timer itself, with an interval that depends on how busy things are.
+" Any timer that is already running is replaced.
+"
+" @param number interval The time to wait in milliseconds
+"
+function! do#StartTimer(interval)
+    call do#StopTimer()
+    let s:timer = timer_start(a:interval, 'do#Tick')
+endfunction
+
+""
+" Stop the timer started by do#StartTimer().
+"
+function! do#StopTimer()
+    if s:timer != -1
+        call timer_stop(s:timer)
+        let s:timer = -1
+    endif
+endfunction
+
+""
+" The timer callback for do#StartTimer().
+"
+function! do#Tick(timer)
+    let s:timer = -1
+    execute s:python "do_async.tick()"
+endfunction
+
+""
+" Start a shell command as a job, for the "job" backend.
+"
+" The job's output and exit status are passed to Python by its callbacks.
+"
+" @param string command The shell command to run
+" @return number The process ID, or 0 if the job couldn't be started
+"
+function! do#JobStart(command)
+    if has("nvim")
+        let l:job = jobstart(a:command, {
+                    \ "on_stdout": function("s:nvimJobOutput", [0]),
+                    \ "on_stderr": function("s:nvimJobOutput", [1]),
+                    \ "on_exit": function("s:nvimJobExit")})
+        if l:job <= 0
+            return 0
+        endif
+        let l:pid = jobpid(l:job)
+        let s:job_pids[l:job] = l:pid
+        return l:pid
+    endif
+
+    let l:job = job_start([&shell, &shellcmdflag, a:command], {
+                \ "mode": "raw",
+                \ "out_cb": function("s:jobOutput", [0]),
+                \ "err_cb": function("s:jobOutput", [1]),
+                \ "close_cb": function("s:jobClosed"),
+                \ "exit_cb": function("s:jobExit")})
+    if job_status(l:job) ==# "fail"
+        return 0
+    endif
+    return job_info(l:job).process
+endfunction
+
 " PRIVATE FUNCTIONS
 " -----------------
 
+" Vim job callbacks, see do#JobStart().
+"
+function! s:jobOutput(stream, channel, msg)
+    let l:pid = job_info(ch_getjob(a:channel)).process
+    execute s:python 'do_async.job_output(int(vim.eval("l:pid")), int(vim.eval("a:stream")), vim.eval("a:msg"))'
+endfunction
+
+function! s:jobClosed(channel)
+    let l:pid = job_info(ch_getjob(a:channel)).process
+    execute s:python 'do_async.job_closed(int(vim.eval("l:pid")))'
+endfunction
+
+function! s:jobExit(job, status)
+    let l:pid = job_info(a:job).process
+    execute s:python 'do_async.job_exited(int(vim.eval("l:pid")), int(vim.eval("a:status")))'
+endfunction
+
+" Neovim job callbacks, see do#JobStart().
+"
+" Neovim splits output into a list of lines, where the last item is a
+" partial line, so joining it gives back the raw output.
+"
+function! s:nvimJobOutput(stream, job, data, event)
+    let l:pid = s:job_pids[a:job]
+    let l:msg = join(a:data, "\n")
+    if !empty(l:msg)
+        execute s:python 'do_async.job_output(int(vim.eval("l:pid")), int(vim.eval("a:stream")), vim.eval("l:msg"))'
+    endif
+endfunction
+
+function! s:nvimJobExit(job, status, event)
+    let l:pid = remove(s:job_pids, a:job)
+    execute s:python 'do_async.job_exited(int(vim.eval("l:pid")), int(vim.eval("a:status")))'
+    execute s:python 'do_async.job_closed(int(vim.eval("l:pid")))'
+endfunction
+
 " Strip whitespace from input strings.
 "
 " @param string input_string The string which requires whitespace stripping
@@ -235,6 +546,14 @@ function! Strip(input_string)
     return substitute(a:input_string, '^\s*\(.\{-}\)\s*$', '\1', '')
 endfunction
 
+" Expand special file modifiers (such as "%") in a command, and strip it.
+"
+" @param string command The command to expand
+"
+function! s:expandCommand(command)
+    return Strip(join(map(split(a:command, '\ze[<%#]'), 'expand(v:val)'), ''))
+endfunction
+
 " Thanks to http://stackoverflow.com/a/6271254/1087866
 function! s:getVisualSelection()
   " Why is this not a built-in Vim script function?!
@@ -246,6 +565,29 @@ function! s:getVisualSelection()
   return join(lines, "\n")
 endfunction
 
-" Initialize do
-python do_async = Do()
-autocmd VimLeavePre * python do_async.stop()
+" Load the Python script and create the Do instance, unless it's already
+" been done.
+"
+" This is left until a command needs it, so that Vim starts up quicker.
+"
+function! s:init()
+    if s:initialised
+        return
+    endif
+    let s:initialised = 1
+
+    if filereadable($VIMRUNTIME."/plugin/python/do.py")
+      execute s:pyfile '$VIMRUNTIME/plugin/do.py'
+    elseif filereadable($HOME."/.vim/plugin/python/do.py")
+      execute s:pyfile '$HOME/.vim/plugin/python/do.py'
+    elseif filereadable(s:script_directory."/python/do.py")
+      " when we use pathogen for instance
+      execute s:pyfile fnameescape(s:script_directory."/python/do.py")
+    else
+      call confirm('vdebug.vim: Unable to find do.py. Place it in either your home vim directory or in the Vim runtime directory.', 'OK')
+      return
+    endif
+
+    execute s:python "do_async = Do()"
+    execute "autocmd VimLeavePre * " . s:python . " do_async.stop()"
+endfunction
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from pool import ProcessPool, ProcessStreams, popen, reap, pause_interval
+from utils import log
+
+class AsyncioProcessPool(ProcessPool):
+    """ Run processes on an asyncio event loop, in one background thread.
+
+    Each process' pipes are watched with the loop's add_reader(), and read
+    without blocking by a ProcessStreams, as AsyncProcessReader does.
+    Complete lines are pushed on to the output queue as they arrive. A
+    process is paused by not reading from it while the queue asks for it
+    to be. Requires Python 3.8 or later.
+
+    Processes are started with Popen rather than asyncio's subprocess
+    functions, and polled for their exit with os.wait4(): asyncio's child
+    watchers would wait for them first, which loses their resource usage.
+    Once a process has exited, whatever is left in its pipes is read until
+    they close, or until there is nothing more to read if a backgrounded
+    grandchild holds them open.
+    """
+    # How often to check whether a process has exited
+    exit_poll_interval = 0.02
+
+    def __init__(self):
+        ProcessPool.__init__(self)
+        self.__loop = None
+        self.__thread = None
+        self.__running = set()
+
+    def execute(self, cmd):
+        future = asyncio.run_coroutine_threadsafe(self.__start(cmd),
+                self.__get_loop())
+        return future.result()
+
+    def any_running(self):
+        return bool(self.__running)
+
+    def cleanup(self):
+        pass
+
+    def stop(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join(1)
+            self.__loop = None
+            self.__thread = None
+
+    async def __start(self, cmd):
+        process = popen(cmd)
+        self.__running.add(process.pid)
+        asyncio.get_running_loop().create_task(self.__watch(process))
+        return process.pid
+
+    async def __watch(self, process):
+        pid = process.pid
+        streams = ProcessStreams(process)
+        exited = asyncio.get_running_loop().create_task(self.__wait(process))
+        try:
+            while not streams.is_closed() and not exited.done():
+                while self._output_q.should_pause(pid) and not exited.done():
+                    await asyncio.sleep(pause_interval)
+                await self.__readable(streams, exited)
+                output = [[], []]
+                for fd in streams.open_fds[:]:
+                    streams.read(fd, output)
+                self.__put(pid, output)
+
+            # Everything the process wrote is in the pipes by now
+            output = [[], []]
+            streams.drain(output)
+            self.__put(pid, output)
+            if not streams.is_closed():
+                log("Stopped reading from %i, its pipes are still open", pid)
+            usage = await exited
+        finally:
+            streams.close()
+            self.__running.discard(pid)
+        log("Finished with %i", process.returncode)
+        self._output_q.put_exit(pid, process.returncode, usage)
+
+    async def __wait(self, process):
+        while True:
+            (exited, usage) = reap(process, False)
+            if exited:
+                return usage
+            await asyncio.sleep(self.exit_poll_interval)
+
+    async def __readable(self, streams, exited):
+        """ Wait until a pipe can be read, or the process has exited """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake(*args):
+            if not ready.done():
+                ready.set_result(None)
+
+        fds = streams.open_fds[:]
+        for fd in fds:
+            loop.add_reader(fd, wake)
+        exited.add_done_callback(wake)
+        try:
+            await ready
+        finally:
+            for fd in fds:
+                loop.remove_reader(fd)
+            exited.remove_done_callback(wake)
+
+    def __put(self, pid, output):
+        if output[0] or output[1]:
+            self._output_q.put_output(pid, output[0], output[1])
+
+    def __get_loop(self):
+        if self.__loop is None:
+            self.__loop = asyncio.new_event_loop()
+            self.__thread = threading.Thread(target=self.__run_loop,
+                    args=(self.__loop,))
+            self.__thread.daemon = True
+            self.__thread.start()
+        return self.__loop
+
+    def __run_loop(self, loop):
+        log("Starting asyncio event loop thread")
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+        # Let the readers of processes that are still running close their
+        # pipes
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks,
+            return_exceptions=True))
+        loop.close()
+        log("Stopped asyncio event loop thread")
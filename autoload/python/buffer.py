@@ -1,4 +1,5 @@
 import vim
+import metrics
 
 class VimBuffer:
     def __init__(self, buffer):
@@ -21,6 +22,7 @@ class VimBuffer:
         if len(to_write) == 1 and to_write[0] == "":
             return (last_line, last_line)
 
+        metrics.count("buffer_writes")
         if overwrite or self.is_empty():
             self._buffer[:] = to_write
         else:
@@ -40,20 +42,16 @@ class VimBuffer:
 
         lstart = lineno - 1
         lend = lstart + len(to_write)
+        metrics.count("buffer_writes")
         self._buffer[lstart:lend] = to_write
 
         return (lstart, lend)
 
     def delete(self, start_line, end_line = None):
-        try:
-            if not end_line:
-                end_line = start_line + 1
-            self._buffer[end_line]
-            remaining_buffer = self._buffer[end_line:]
-            del self._buffer[start_line:]
-            self._buffer.append(remaining_buffer)
-        except IndexError:
-            del self._buffer[start_line:]
+        metrics.count("buffer_writes")
+        if not end_line:
+            end_line = start_line + 1
+        del self._buffer[start_line:end_line]
 
     def contents(self):
         return self._buffer[:]
@@ -67,6 +65,9 @@ class VimBuffer:
         else:
             return False
 
+    def is_valid(self):
+        return self._buffer.valid
+
 class HiddenBuffer:
     def __init__(self, buffer = []):
         self._buffer = buffer[:]
@@ -88,8 +89,6 @@ class HiddenBuffer:
         if len(to_write) == 1 and to_write[0] == "":
             return (last_line, last_line)
 
-        to_write = str(msg).split('\n')
-
         if overwrite or self.is_empty():
             self._buffer[:] = to_write
         else:
@@ -115,12 +114,9 @@ class HiddenBuffer:
         return (lstart, lend)
 
     def delete(self, start_line, end_line = None):
-        try:
-            if not end_line:
-                end_line = start_line + 1
-            self._buffer[start_line:end_line] = []
-        except IndexError:
-            del self._buffer[start_line:]
+        if not end_line:
+            end_line = start_line + 1
+        del self._buffer[start_line:end_line]
 
     def clean(self):
         self._buffer[:] = []
@@ -131,4 +127,7 @@ class HiddenBuffer:
     def is_empty(self):
         return not self._buffer
 
+    def is_valid(self):
+        return True
+
 
@@ -0,0 +1,196 @@
+import os
+import json
+import array
+import zlib
+import time
+import hashlib
+from utils import log, to_bytes
+
+class ResultCache:
+    """ Stored output and exit codes of commands, on disk.
+
+    Results are keyed on the command, the working directory and the input
+    globs the command declares. A stored result is only used if the files
+    matching the globs are unchanged: each file's mtime and size are
+    compared first, and if they differ its content hash is compared
+    instead. The least recently used results are removed once the cache
+    grows beyond max_bytes.
+    """
+    index_name = "index.json"
+    # The format of stored results. Results stored in other formats are
+    # treated as missing, and replaced when the command next runs.
+    version = 2
+
+    def __init__(self, directory, max_bytes):
+        self.__directory = os.path.expanduser(directory)
+        self.__max_bytes = max_bytes
+        self.__index = None
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0
+
+    def key(self, command, cwd, globs):
+        return hashlib.sha1(to_bytes(json.dumps([command, cwd,
+            sorted(globs)]))).hexdigest()
+
+    def lookup(self, key, paths):
+        """ Get the stored result for key, if its inputs are unchanged.
+
+        Returns a CachedResult, or None.
+        """
+        entry = self.__get_index().get(key)
+        result = None
+        if entry is not None:
+            result = self.__read(key)
+            if result is not None and not result.matches(paths):
+                result = None
+
+        if result is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.time_saved += result.time
+        entry["used"] = time.time()
+        self.__write_index()
+        return result
+
+    def fingerprint(self, paths):
+        """ Get the current fingerprint of the files at paths """
+        fingerprints = [file_fingerprint(path, True)
+                for path in sorted(set(paths))]
+        return [f for f in fingerprints if f is not None]
+
+    def store(self, key, fingerprint, exit_code, output, run_time):
+        """ Store the OutputSnapshot and exit code of a finished command.
+
+        The output is stored as it is kept in memory: a JSON header line,
+        then the stream tag of each line as a byte, then the lines.
+        """
+        streams = output.streams()
+        header = json.dumps({
+            "version": self.version,
+            "inputs": fingerprint,
+            "exit_code": exit_code,
+            "time": run_time,
+            "lines": len(streams)})
+        data = zlib.compress(b"\n".join([to_bytes(header),
+            bytes(bytearray(streams)) + output.encoded()]))
+        if len(data) > self.__max_bytes:
+            log("Not caching result of %i bytes", len(data))
+            return
+
+        try:
+            if not os.path.isdir(self.__directory):
+                os.makedirs(self.__directory)
+            with open(self.__path(key), "wb") as f:
+                f.write(data)
+        except (IOError, OSError) as e:
+            log("Failed to write cache entry: %s", e)
+            return
+
+        self.__get_index()[key] = {"size": len(data), "used": time.time()}
+        self.__evict()
+        self.__write_index()
+
+    def stats(self):
+        return "Cache: %i hits, %i misses, %ss saved" \
+                %(self.hits, self.misses, round(self.time_saved / 1000.0, 2))
+
+    def __read(self, key):
+        try:
+            with open(self.__path(key), "rb") as f:
+                (header, output) = zlib.decompress(f.read()).split(b"\n", 1)
+            data = json.loads(header.decode("utf-8"))
+            if data.get("version") != self.version:
+                raise ValueError("unknown version %s" % data.get("version"))
+            count = data["lines"]
+            streams = array.array('B', bytearray(output[:count]))
+            output = output[count:]
+            if len(streams) != count or output.count(b"\n") != count or \
+                    (count and not output.endswith(b"\n")):
+                raise ValueError("output doesn't match its header")
+        except (IOError, OSError, ValueError, KeyError, zlib.error) as e:
+            log("Failed to read cache entry: %s", e)
+            del self.__get_index()[key]
+            return None
+        return CachedResult(data["inputs"], data["exit_code"],
+                data["time"], output, streams)
+
+    def __evict(self):
+        index = self.__get_index()
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["used"]):
+            if total <= self.__max_bytes:
+                break
+            total -= index[key]["size"]
+            del index[key]
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+
+    def __get_index(self):
+        if self.__index is None:
+            try:
+                with open(self.__path(self.index_name)) as f:
+                    self.__index = json.load(f)
+            except (IOError, ValueError):
+                self.__index = {}
+        return self.__index
+
+    def __write_index(self):
+        try:
+            if not os.path.isdir(self.__directory):
+                os.makedirs(self.__directory)
+            with open(self.__path(self.index_name), "w") as f:
+                json.dump(self.__index, f)
+        except (IOError, OSError) as e:
+            log("Failed to write cache index: %s", e)
+
+    def __path(self, name):
+        return os.path.join(self.__directory, name)
+
+
+class CachedResult:
+    """ A stored result, where output is the lines as UTF-8 bytes, each
+    ending in a newline, and streams is the stream tag of each line """
+    def __init__(self, inputs, exit_code, time, output, streams):
+        self.inputs = inputs
+        self.exit_code = exit_code
+        self.time = time
+        self.output = output
+        self.streams = streams
+
+    def matches(self, paths):
+        """ Whether the files at paths are the same as the stored inputs """
+        if sorted(set(paths)) != [i[0] for i in self.inputs]:
+            return False
+        for (path, mtime, size, digest) in self.inputs:
+            current = file_fingerprint(path, False)
+            if current is None:
+                return False
+            if current[1:3] != [mtime, size] and \
+                    file_fingerprint(path, True)[3] != digest:
+                return False
+        return True
+
+
+def file_fingerprint(path, with_digest):
+    """ Get [path, mtime, size, sha1] for a file.
+
+    The sha1 is only calculated if with_digest is True. Returns None if the
+    file doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    digest = None
+    if with_digest:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+    return [path, stat.st_mtime, stat.st_size, digest]
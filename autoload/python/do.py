@@ -5,36 +5,221 @@ directory = os.path.dirname(inspect.getfile(inspect.currentframe()))
 sys.path.append(directory)
 
 import rendering
-import async
+import pool
+import jobs
+import cache
+import filters
+import quickfix
+import history
+import metrics
+import re
 import window
 import vim
 import time
 import string
 import signal
+import collections
+import itertools
+from output import Output
 from utils import *
 
 class Do:
     def __init__(self):
-        self.__process_pool = async.ProcessPool()
+        try:
+            self.__process_pool = pool.create(Options.backend())
+        except pool.BackendError as e:
+            vim.command("call do#error('%s')" % str(e).replace("'", "''"))
+            self.__process_pool = pool.create("auto")
+        self.__job_queue = jobs.JobQueue(self.__process_pool)
+        self.__batches = []
+        self.__pipelines = []
+        self.__cache = None
+        self.__uncached = {}
+        self.__quickfix = None
+        self.__history = None
+        self.__history_window = window.HistoryWindow()
+        self.__stats_window = window.StatsWindow()
         self.__processes = ProcessCollection()
         self.__process_renderer = rendering.ProcessRenderer()
-        self.__au_assigned = False
+        self.__checking = False
+        self.__scheduler = CheckScheduler()
         self.__last_check = time.time() * 1000
+        metrics.Metrics.enable(Options.metrics())
 
     def __del__(self):
         self.stop()
 
-    def execute(self, cmd, quiet = False):
-        pid = self.__process_pool.execute(cmd)
-        log("Started command with pid %i: %s" %(pid, cmd))
-        process = self.__processes.add(cmd, pid)
+    def execute(self, cmd, quiet = False, priority = 0, timeout = None):
+        """ Queue a command, and start it if there is a free slot.
+
+        The command is terminated if it runs for longer than timeout
+        seconds, which defaults to g:do_timeout.
+        """
+        process = self.__submit(cmd, quiet, priority)
+        if timeout is not None:
+            process.set_timeout(timeout)
+        if Options.quickfix():
+            self.__quickfix = quickfix.QuickfixParser(process,
+                    vim.eval("&errorformat"))
+            vim.command("call setqflist([], 'r')")
+        self.__process_renderer.update_processes(self.__start_jobs())
+
+        self.__scheduler.reset()
+        self.__start_checking()
+        self.check()
+        return process
+
+    def execute_cached(self, cmd, globs, quiet = False):
+        """ Execute a command, unless it has a cached result.
+
+        The cache is keyed on the command, the current directory and the
+        globs of its input files. If the files matching the globs haven't
+        changed since the result was stored, the stored output and exit code
+        are shown straight away instead of running the command.
+        """
+        result_cache = self.__get_cache()
+        key = result_cache.key(cmd, os.getcwd(), globs)
+        paths = self.__expand_globs(globs)
+        result = result_cache.lookup(key, paths)
+        if result is None:
+            fingerprint = result_cache.fingerprint(paths)
+            process = self.execute(cmd, quiet)
+            self.__uncached[process.get_id()] = (key, fingerprint)
+            return
+
+        log("Using cached result for: %s", cmd)
+        process = self.__processes.add(cmd)
+        self.__processes.replay(process, result.exit_code, result.output,
+                result.streams)
         self.__process_renderer.add_process(process, quiet)
+        vim.command("echomsg 'Using cached result, saved %s'"
+                % rendering.format_time(result.time))
 
-        self.__assign_autocommands()
+        self.__start_checking()
         self.check()
 
+    def cache_stats(self):
+        vim.command("echomsg '%s'" % self.__get_cache().stats())
+
+    def execute_batch(self, cmds, quiet = True):
+        """ Queue several commands together.
+
+        When they have all finished, the wall time of the batch is reported
+        against the sum of the individual run times.
+        """
+        processes = [self.__submit(cmd, quiet) for cmd in cmds]
+        self.__batches.append(jobs.Batch(processes))
+        self.__process_renderer.update_processes(self.__start_jobs())
+
+        self.__scheduler.reset()
+        self.__start_checking()
+        self.check()
+
+    def execute_pipeline(self, stages):
+        """ Run a pipeline of commands with dependencies between them.
+
+        Stages are dicts with a "name", a "command", and optionally "after",
+        a list of the names of the stages that it depends on.
+        """
+        try:
+            pipeline = jobs.Pipeline([(s["name"], s["command"],
+                s.get("after", [])) for s in stages])
+        except (jobs.PipelineError, KeyError) as e:
+            vim.command("call do#error('%s')"
+                    % str(e).replace("'", "''"))
+            return
+
+        for (name, command) in pipeline.stages():
+            process = self.__processes.add(command, name)
+            pipeline.attach(name, process)
+            self.__process_renderer.add_process(process, True)
+        self.__pipelines.append(pipeline)
+
+        self.__process_renderer.update_processes(self.__advance_pipelines())
+
+        self.__scheduler.reset()
+        self.__start_checking()
+        self.check()
+
+    def show_history(self, pattern = None):
+        """ Show the most recent runs, optionally those whose command
+        contains pattern. """
+        store = self.__get_history()
+        if store is None:
+            return
+        started = time.time()
+        runs = store.recent(pattern)
+        lines = ["%i runs (%.1fms)" %(len(runs),
+            (time.time() - started) * 1000)]
+        lines.extend(str(run) for run in runs)
+        self.__show_history_window(lines)
+
+    def grep_history(self, pattern):
+        """ Search the output of past runs with a (Python) regex """
+        store = self.__get_history()
+        if store is None:
+            return
+        started = time.time()
+        try:
+            results = store.grep(pattern)
+        except re.error as e:
+            vim.command("call do#error('Invalid pattern: %s')"
+                    % str(e).replace("'", "''"))
+            return
+
+        lines = ["%i matching lines (%.1fms)" %(len(results),
+            (time.time() - started) * 1000)]
+        last_run = None
+        for (run, number, line) in results:
+            if run.id != last_run:
+                lines.append("")
+                lines.append(str(run))
+                last_run = run.id
+            lines.append("%6i: %s" %(number, line))
+        self.__show_history_window(lines)
+
+    def mark_history_window_as_closed(self):
+        self.__history_window.destroy()
+
+    def job_output(self, pid, index, data):
+        """ Output from a job, for the job backend """
+        self.__process_pool.output(pid, index, data)
+        self.__wake()
+
+    def job_exited(self, pid, exit_code):
+        self.__process_pool.exited(pid, exit_code)
+        self.__wake()
+
+    def job_closed(self, pid):
+        self.__process_pool.closed(pid)
+        self.__wake()
+
     def reload_options(self):
         Options.reload()
+        metrics.Metrics.enable(Options.metrics())
+
+    def show_stats(self):
+        if not metrics.Metrics.enabled:
+            vim.command("call do#error('Set g:do_metrics to 1 to collect "
+                    "metrics')")
+            return
+        self.__stats_window.clean()
+        self.__stats_window.create(Options.new_process_window_command())
+        self.__stats_window.write(metrics.Metrics.report())
+
+    def mark_stats_window_as_closed(self):
+        self.__stats_window.destroy()
+
+    def export_stats(self, path):
+        """ Write the metrics as JSON to the file at path """
+        try:
+            with open(os.path.expanduser(path), "w") as f:
+                f.write(metrics.Metrics.to_json())
+        except IOError as e:
+            vim.command("call do#error('Failed to write metrics: %s')"
+                    % str(e).replace("'", "''"))
+            return
+        vim.command("echomsg 'Wrote metrics to %s'" % path.replace("'", "''"))
 
     def toggle_command_window(self):
         self.__process_renderer.toggle_command_window()
@@ -45,161 +230,727 @@ class Do:
     def mark_process_window_as_closed(self):
         try:
             self.__process_renderer.destroy_process_window()
-        except Exception, e:
-            log("Error: %s" % str(e))
+        except Exception as e:
+            log("Error: %s", e)
+
+    def filter_output(self, args):
+        """ Filter the process window: args are "stderr", "/pattern/",
+        "context <lines>" or "off" """
+        try:
+            spec = filters.parse(args,
+                    self.__process_renderer.get_filter())
+        except filters.FilterError as e:
+            vim.command("call do#error('%s')" % str(e).replace("'", "''"))
+            return
+        self.__process_renderer.set_filter(spec)
+        if self.__process_renderer.has_pending_output():
+            self.__scheduler.reset()
+            self.__start_checking()
 
     def show_process_from_command_window(self):
         lineno = vim.current.window.cursor[0]
-        pid = self.__process_renderer.get_pid_by_line_number(lineno)
-        process = self.__processes.get_by_pid(pid)
+        process_id = self.__process_renderer.get_id_by_line_number(lineno)
+        process = self.__processes.get_by_id(process_id)
         if process is not None:
             self.__process_renderer.show_process(process)
 
     def check(self):
         log("check()")
-        if (1000 * time.time()) - self.__last_check > Options.check_interval():
-            self.check_now()
+        started = time.time() * 1000
+        if started - self.__last_check > self.__scheduler.interval():
+            active = self.check_now()
             self.__last_check = time.time() * 1000
+            self.__scheduler.record(active, self.__last_check - started)
+
+    def tick(self):
+        """ Check processes, but only if there is something new to show """
+        started = time.time()
+        active = False
+        failed = True
+        try:
+            active = self.__process_pool.has_output() or \
+                    self.__processes.has_timeouts_due() or \
+                    self.__process_renderer.has_pending_output() or \
+                    (self.__quickfix is not None and
+                            self.__quickfix.has_pending_output())
+            if active:
+                self.check_now()
+            else:
+                metrics.count("idle_ticks")
+            failed = False
+        finally:
+            # The timer only fires once, so it is started again even if the
+            # check failed, or checking would stop for good. A failed check
+            # backs off, like an idle one.
+            self.__scheduler.record(active and not failed,
+                    (time.time() - started) * 1000)
+            if self.__checking:
+                vim.command('call do#StartTimer(%i)'
+                        % self.__scheduler.interval())
 
     def check_now(self):
+        """ Collect output and update windows.
+
+        Returns whether there was any new output or exit status.
+        """
         log("Checking background threads output")
-        outputs = self.__process_pool.get_outputs()
-        changed_processes = set()
-        for output in outputs:
-            if output[1] is not None:
-                log("Process %s has finished with exit status %s"
-                    %(output[0], output[1]))
-            process = self.__processes.update(*output)
-            changed_processes.add(process)
-
-        for process in changed_processes:
-            self.__process_renderer.update_process(process)
+        started = time.time()
+        deadline = started + Options.check_budget() / 1000.0
+        queue_depth = self.__process_pool.queued_lines()
+        outputs = self.__process_pool.get_outputs(deadline)
+        changed_processes = set(self.__update_throttled())
+        ingested = 0
+        for (pid, exit_status, lines, stderr) in self.__coalesce(outputs):
+            ingested += len(lines)
+            if exit_status is not None:
+                log("Process %s has finished with exit status %s",
+                    pid, exit_status)
+            process = self.__processes.update(pid, exit_status, lines,
+                    stderr)
+            if process is not None:
+                changed_processes.add(process)
+                if exit_status is not None:
+                    process.set_resource_usage(
+                            self.__process_pool.resource_usage(pid))
+                    self.__job_queue.finished(process)
+                    self.__store_result(process)
+                    self.__record_history(process)
+
+        changed_processes.update(self.__processes.enforce_timeouts())
+        changed_processes.update(self.__advance_pipelines())
+        changed_processes.update(self.__start_jobs())
+        self.__process_renderer.update_processes(changed_processes)
+        self.__process_renderer.render_output()
+        self.__update_quickfix(deadline)
+
+        evicted = self.__processes.evict()
+        if evicted:
+            log("Evicted %i finished processes", len(evicted))
+            self.__process_renderer.remove_processes(evicted)
+
+        self.__report_finished_batches()
+        self.__report_finished_pipelines()
 
         self.__process_pool.cleanup()
-        if self.__processes.all_finished():
+        if self.__processes.all_finished() and \
+                not self.__processes.any_terminating() and \
+                not self.__process_renderer.has_pending_output() and \
+                self.__quickfix is None:
             log("All background threads completed")
-            self.__unassign_autocommands()
-        else:
+            self.__stop_checking()
+        elif not Options.use_timers():
             s = 'feedkeys("\\%s")' % Options.refresh_key()
             log(s)
             vim.eval(s)
 
+        metrics.count("checks")
+        metrics.count("lines_ingested", ingested)
+        metrics.observe("lines_per_check", ingested)
+        metrics.observe("queue_depth", queue_depth)
+        metrics.observe("commands_queued", self.__job_queue.queued())
+        metrics.observe("check_time_ms", (time.time() - started) * 1000)
+        return bool(outputs)
+
+    def __submit(self, cmd, quiet, priority = 0):
+        process = self.__processes.add(cmd)
+        self.__job_queue.submit(process, priority)
+        self.__process_renderer.add_process(process, quiet)
+        return process
+
+    def __start_jobs(self):
+        """ Start queued processes, returning those that were started or
+        failed to start """
+        changed = []
+        (started, failed) = self.__job_queue.start_ready()
+        for (process, pid) in started:
+            self.__processes.mark_as_started(process, pid,
+                    self.__process_pool.process_groups)
+            changed.append(process)
+        for (process, error) in failed:
+            self.__processes.mark_as_failed(process, error)
+            vim.command("call do#error('Failed to start %s: %s')"
+                    %(process.get_command().replace("'", "''"),
+                        error.replace("'", "''")))
+            changed.append(process)
+        return changed
+
+    def __update_quickfix(self, deadline):
+        """ Add entries parsed from the latest :Do command's output to the
+        quickfix list. """
+        parser = self.__quickfix
+        if parser is None:
+            return
+        # Parse at least some output, even if collecting it used up the
+        # budget of this check
+        entries = parser.parse(max(deadline, time.time() + 0.01))
+        if entries:
+            log("Adding %i quickfix entries", len(entries))
+            vim.command("call setqflist(%s, 'a')" % quickfix.to_vim(entries))
+        if parser.has_finished():
+            self.__quickfix = None
+
+    def __get_history(self):
+        if self.__history is None:
+            if not Options.history_file():
+                vim.command("call do#error('Set g:do_history_file to keep "
+                        "a history of runs')")
+                return None
+            try:
+                self.__history = history.HistoryStore(Options.history_file())
+            except history.HistoryError as e:
+                vim.command("call do#error('%s')"
+                        % str(e).replace("'", "''"))
+                return None
+        return self.__history
+
+    def __record_history(self, process):
+        if not Options.history_file():
+            return
+        store = self.__get_history()
+        if store is not None:
+            store.record(process.get_command(), process.get_cwd(),
+                    process.get_exit_code(), process.get_start_time(),
+                    process.get_time(), process.output().snapshot())
+
+    def __show_history_window(self, lines):
+        self.__history_window.clean()
+        self.__history_window.create(Options.new_process_window_command())
+        self.__history_window.write(lines)
+
+    def __get_cache(self):
+        if self.__cache is None:
+            self.__cache = cache.ResultCache(Options.cache_dir(),
+                    Options.cache_size())
+        return self.__cache
+
+    def __expand_globs(self, globs):
+        paths = []
+        for pattern in globs:
+            paths.extend(vim.eval("glob('%s', 0, 1)"
+                % pattern.replace("'", "''")))
+        return [p for p in paths if os.path.isfile(p)]
+
+    def __store_result(self, process):
+        uncached = self.__uncached.pop(process.get_id(), None)
+        if uncached is None:
+            return
+        if not process.ran_to_completion():
+            log("Not caching the result of %s, as it was stopped or lost "
+                    "output", process.get_command())
+            return
+        (key, fingerprint) = uncached
+        self.__get_cache().store(key, fingerprint, process.get_exit_code(),
+                process.output().snapshot(), process.get_time())
+
+    def __advance_pipelines(self):
+        """ Queue and skip pipeline stages, returning the changed processes """
+        changed = []
+        for pipeline in self.__pipelines:
+            (ready, skipped) = pipeline.advance()
+            for process in skipped:
+                self.__processes.mark_as_skipped(process)
+            for process in ready:
+                process.mark_as_queued()
+                self.__job_queue.submit(process)
+            changed.extend(skipped)
+            changed.extend(ready)
+        if changed:
+            changed.extend(self.__start_jobs())
+        return changed
+
+    def __report_finished_pipelines(self):
+        for pipeline in [p for p in self.__pipelines if p.has_finished()]:
+            self.__pipelines.remove(pipeline)
+            log(str(pipeline))
+            vim.command("echomsg '%s'" % str(pipeline).replace("'", "''"))
+
+    def __report_finished_batches(self):
+        for batch in [b for b in self.__batches if b.has_finished()]:
+            self.__batches.remove(batch)
+            log(str(batch))
+            vim.command("echomsg '%s'" % str(batch).replace("'", "''"))
+
+    def __update_throttled(self):
+        """ Record which processes are throttled, and how many of their
+        lines have been dropped. Returns the processes that changed. """
+        changed = []
+        for (pid, state) in self.__process_pool.throttle_states().items():
+            process = self.__processes.get_by_pid(pid)
+            if process is not None and process.get_throttle() != state:
+                process.set_throttle(*state)
+                changed.append(process)
+        return changed
+
+    def __coalesce(self, outputs):
+        """ Merge queued batches into one list of lines per process.
+
+        Returns a list of (pid, exit_status, lines, stderr), in the order
+        that each pid first appears in the queue, where stderr is a list of
+        the (offset, count) runs of lines that came from stderr.
+        """
+        batches = {}
+        order = []
+        for (pid, exit_status, stdout, stderr) in outputs:
+            batch = batches.get(pid)
+            if batch is None:
+                batch = batches[pid] = [pid, None, [], []]
+                order.append(pid)
+            if exit_status is not None:
+                batch[1] = exit_status
+            if stdout:
+                batch[2].extend(stdout)
+            if stderr:
+                batch[3].append((len(batch[2]), len(stderr)))
+                batch[2].extend(stderr)
+        return [batches[pid] for pid in order]
+
     def enable_logger(self, path):
         Log.set_logger(FileLogger(Logger.DEBUG, path))
 
     def stop(self):
-        self.__processes.kill_all()
+        self.__job_queue.clear()
+        self.__processes.kill_all(Options.kill_grace() / 1000.0)
         self.__process_pool.stop()
+        if self.__history is not None:
+            self.__history.stop()
 
-    def __assign_autocommands(self):
-        if self.__au_assigned:
+    def __start_checking(self):
+        if self.__checking:
             return
-        log("Assigning autocommands for background checking")
-        vim.command('call do#AssignAutocommands()')
-        self.__au_assigned = True
+        if Options.use_timers():
+            log("Starting timer for background checking")
+            vim.command('call do#StartTimer(%i)' % self.__scheduler.interval())
+        else:
+            log("Assigning autocommands for background checking")
+            vim.command('call do#AssignAutocommands()')
+        self.__checking = True
+
+    def __wake(self):
+        """ Bring the next check forward, if checks have backed off """
+        if self.__checking and Options.use_timers() and \
+                self.__scheduler.interval() > Options.check_interval_min():
+            self.__scheduler.reset()
+            vim.command('call do#StartTimer(%i)' % self.__scheduler.interval())
+
+    def __stop_checking(self):
+        if Options.use_timers():
+            log("Stopping timer")
+            vim.command('call do#StopTimer()')
+        else:
+            log("Unassigning autocommands")
+            vim.command('call do#UnassignAutocommands()')
+        self.__checking = False
+
+
+class CheckScheduler:
+    """ Decide how long to wait between checks.
+
+    While output is arriving, or a process has just exited, checks are made
+    every g:do_check_interval_min milliseconds. While everything is quiet the
+    interval doubles on each check, up to g:do_check_interval. The interval
+    is also kept to several times the cost of the last check, so that slow
+    rendering doesn't take over Vim.
+    """
+    backoff = 2
+    cost_factor = 4
+
+    def __init__(self):
+        self.__interval = None
+
+    def interval(self):
+        if self.__interval is None:
+            return Options.check_interval_min()
+        return self.__interval
+
+    def record(self, active, cost):
+        """ Record a check, and how long it took in milliseconds """
+        if active or self.__interval is None:
+            interval = Options.check_interval_min()
+        else:
+            interval = self.__interval * self.backoff
+        interval = max(interval, cost * self.cost_factor)
+        self.__interval = int(min(max(interval, Options.check_interval_min()),
+                Options.check_interval()))
 
-    def __unassign_autocommands(self):
-        log("Unassigning autocommands")
-        vim.command('call do#UnassignAutocommands()')
-        self.__au_assigned = False
+    def reset(self):
+        self.__interval = None
 
 
 class ProcessCollection:
+    """ All processes that have been submitted, keyed by process id.
+
+    Processes that haven't finished (running or queued) are also indexed
+    separately, as are started processes by pid, so that checking and
+    killing them doesn't depend on how many processes have ever been run.
+    """
     def __init__(self):
         self.__processes = {}
-
-    def add(self, command, pid):
-        process = Process(command, pid)
-        self.__processes[pid] = process
+        self.__running = {}
+        self.__by_pid = {}
+        self.__ids = itertools.count(1)
+        self.__finished = collections.deque()
+        self.__finished_output_lines = 0
+        self.__terminating = []
+
+    def add(self, command, stage = None):
+        process = Process(command, next(self.__ids), stage)
+        self.__processes[process.get_id()] = process
+        self.__running[process.get_id()] = process
         return process
 
+    def mark_as_started(self, process, pid, process_group):
+        process.mark_as_started(pid, process_group)
+        self.__by_pid[process.get_pid()] = process
+
+    def replay(self, process, exit_code, data, streams):
+        """ Complete a process with a cached result, without running it """
+        process.output().extend_encoded(data, streams)
+        process.mark_as_cached(exit_code)
+        self.__running.pop(process.get_id(), None)
+        self.__finished.append(process)
+        self.__finished_output_lines += len(process.output())
+
+    def mark_as_skipped(self, process):
+        process.mark_as_skipped()
+        self.__running.pop(process.get_id(), None)
+        self.__finished.append(process)
+
+    def mark_as_failed(self, process, error):
+        """ Finish a process that couldn't be started, showing the error
+        as its output """
+        process.output().extend([error], [(0, 1)])
+        process.mark_as_failed()
+        self.__running.pop(process.get_id(), None)
+        self.__finished.append(process)
+        self.__finished_output_lines += len(process.output())
+
+    def get_by_id(self, process_id):
+        return self.__processes.get(process_id)
+
     def get_by_pid(self, pid):
-        return next((p for p in self.__processes.values() if p.get_pid() == pid), None)
+        """ Get a running process by pid """
+        return self.__by_pid.get(pid)
 
-    def update(self, pid, exit_status, stdout, stderr):
-        process = self.__processes[pid]
+    def update(self, pid, exit_status, lines, stderr = ()):
+        process = self.__by_pid.get(pid)
         if process is not None:
+            if lines:
+                process.output().extend(lines, stderr)
             if exit_status is not None:
                 process.mark_as_complete(exit_status)
-            if stdout or stderr:
-                process.output().append(stdout, stderr)
+                self.__running.pop(process.get_id(), None)
+                # Pids are reused by the OS
+                del self.__by_pid[pid]
+                self.__finished.append(process)
+                self.__finished_output_lines += len(process.output())
+        return process
+
+    def evict(self):
+        """ Remove finished processes that fall outside the retention policy.
+
+        The policy is set by g:do_keep_finished (a number of processes),
+        g:do_keep_minutes and g:do_keep_output_lines (the total output of
+        all finished processes). Evicted processes have their output
+        released, and are returned.
+        """
+        finished = self.__finished
+        evicted = []
+
+        keep_finished = Options.keep_finished()
+        while keep_finished and len(finished) > keep_finished:
+            evicted.append(self.__evict_oldest())
+
+        keep_minutes = Options.keep_minutes()
+        if keep_minutes:
+            cutoff = time.time() - keep_minutes * 60
+            while finished and finished[0].get_end_time() < cutoff:
+                evicted.append(self.__evict_oldest())
+
+        keep_output_lines = Options.keep_output_lines()
+        while keep_output_lines and finished and \
+                self.__finished_output_lines > keep_output_lines:
+            evicted.append(self.__evict_oldest())
+
+        return evicted
+
+    def __evict_oldest(self):
+        process = self.__finished.popleft()
+        self.__finished_output_lines -= len(process.output())
+        del self.__processes[process.get_id()]
+        process.output().release()
         return process
 
     def all_finished(self):
-        return len(self.get_running()) == 0
+        return not self.__running
 
     def get_running(self):
-        return filter(lambda p: p.is_running(), self.__processes.values())
-
-    def kill_all(self):
-        for process in self.get_running():
-            process.kill()
+        return list(self.__running.values())
+
+    def enforce_timeouts(self):
+        """ Terminate processes that have run for longer than their
+        timeout, and kill those that are still running g:do_kill_grace
+        milliseconds after being terminated.
+
+        Returns the processes that timed out.
+        """
+        now = time.time()
+        timed_out = [process for process in self.get_running()
+                if process.has_timed_out(now)]
+        for process in timed_out:
+            log("Process %s has timed out", process.get_pid())
+            process.terminate()
+            self.__terminating.append(process)
+
+        grace = Options.kill_grace() / 1000.0
+        while self.__terminating and \
+                self.__terminating[0].get_terminate_time() + grace <= now:
+            self.__terminating.pop(0).kill()
+        return timed_out
+
+    def has_timeouts_due(self):
+        """ Whether enforce_timeouts() has anything to do """
+        now = time.time()
+        if self.__terminating and self.__terminating[0].get_terminate_time() \
+                + Options.kill_grace() / 1000.0 <= now:
+            return True
+        return any(process.has_timed_out(now)
+                for process in self.get_running())
+
+    def any_terminating(self):
+        return bool(self.__terminating)
+
+    def kill_all(self, grace):
+        """ Terminate all running processes, and kill any that haven't
+        stopped after grace seconds """
+        processes = self.__terminating + [process for process
+                in self.get_running() if process.get_pid() is not None]
+        for process in processes:
+            process.terminate()
+        deadline = time.time() + grace
+        while processes and time.time() < deadline:
+            time.sleep(0.02)
+            processes = [process for process in processes
+                    if process.is_alive()]
+        for process in processes:
+            log("Killing process %s", process.get_pid())
+            process.send_signal(signal.SIGKILL)
+        self.__terminating = []
 
 class Process:
-    def __init__(self, command, pid):
+    def __init__(self, command, process_id, stage = None):
         self.__command = command
-        self.__pid = str(pid)
-        self.__start_time = time.time()
+        self.__id = process_id
+        self.__stage = stage
+        # Pipeline stages wait for their dependencies before being queued
+        self.__waiting = stage is not None
+        self.__skipped = False
+        self.__cached = False
+        self.__failed = False
+        self.__pid = None
+        self.__cwd = None
+        self.__start_time = None
         self.__output = Output()
         self.__exit_code = None
         self.__time = None
+        self.__end_time = None
+        self.__throttled = False
+        self.__dropped = 0
+        self.__process_group = False
+        self.__timeout = Options.timeout()
+        self.__terminate_time = None
+        self.__timed_out = False
+        self.__usage = None
+
+    def mark_as_queued(self):
+        self.__waiting = False
+
+    def mark_as_skipped(self):
+        self.__waiting = False
+        self.__skipped = True
+        self.__end_time = time.time()
+
+    def mark_as_failed(self):
+        self.__waiting = False
+        self.__failed = True
+        self.__start_time = self.__end_time = time.time()
+        self.__time = 0
+
+    def mark_as_cached(self, exit_code):
+        self.__cached = True
+        self.__start_time = self.__end_time = time.time()
+        self.__exit_code = str(exit_code)
+        self.__time = 0
+
+    def mark_as_started(self, pid, process_group = False):
+        self.__pid = int(pid)
+        self.__process_group = process_group
+        self.__cwd = os.getcwd()
+        self.__start_time = time.time()
 
     def mark_as_complete(self, exit_code):
         self.__exit_code = str(exit_code)
-        self.__time = round((time.time() - self.__start_time) * 1000)
+        self.__end_time = time.time()
+        self.__time = round((self.__end_time - self.__start_time) * 1000)
 
     def has_finished(self):
-        return self.__exit_code is not None
+        return self.__exit_code is not None or self.__skipped or \
+                self.__failed
+
+    def succeeded(self):
+        return self.__exit_code == "0"
+
+    def ran_to_completion(self):
+        """ Whether the process exited by itself, rather than being
+        terminated or killed by a signal, and none of its output was
+        dropped """
+        return self.__exit_code is not None and \
+                not self.__exit_code.startswith("-") and \
+                self.__terminate_time is None and not self.__dropped
 
     def is_running(self):
         return not self.has_finished()
 
+    def get_id(self):
+        return self.__id
+
     def get_pid(self):
         return self.__pid
 
+    def set_throttle(self, throttled, dropped):
+        self.__throttled = throttled
+        self.__dropped = dropped
+
+    def get_throttle(self):
+        return (self.__throttled, self.__dropped)
+
     def get_status(self):
-        if self.__exit_code is None:
-            return "Running"
+        if self.__skipped:
+            return "Skipped"
+        elif self.__failed:
+            return "Failed to start"
+        elif self.__waiting:
+            return "Waiting"
+        elif self.__exit_code is None and self.__pid is None:
+            return "Queued"
+        elif self.__exit_code is None:
+            return "Running" + self.__throttle_status(self.__throttled)
+        elif self.__cached:
+            return "cached <%s>" % self.__exit_code
+        elif self.__timed_out:
+            return "timed out <%s>" % self.__exit_code + \
+                    self.__throttle_status(False)
         else:
-            return "exited <%s>" % self.__exit_code
+            return "exited <%s>" % self.__exit_code + \
+                    self.__throttle_status(False)
+
+    def __throttle_status(self, throttled):
+        details = []
+        if throttled:
+            details.append("throttled")
+        if self.__dropped:
+            details.append("%s lines dropped"
+                    % rendering.format_count(self.__dropped))
+        return " (%s)" % ", ".join(details) if details else ""
+
+    def get_cwd(self):
+        return self.__cwd
+
+    def get_exit_code(self):
+        return self.__exit_code
+
+    def get_start_time(self):
+        return self.__start_time
+
+    def get_end_time(self):
+        return self.__end_time
 
     def get_command(self):
         return self.__command
 
+    def get_stage(self):
+        return self.__stage
+
     def get_time(self):
         if self.__time:
             return self.__time
+        elif self.__start_time is None:
+            return 0
         else:
             return round((time.time() - self.__start_time) * 1000)
 
-    def output(self):
-        return self.__output
+    def set_timeout(self, timeout):
+        """ Set the timeout in seconds, or 0 for none """
+        self.__timeout = timeout
 
-    def name(self):
-        return "DoOutput(%s)" % self.__pid
+    def has_timed_out(self, now):
+        return bool(self.__timeout) and self.__start_time is not None and \
+                self.__terminate_time is None and \
+                now - self.__start_time > self.__timeout
+
+    def terminate(self):
+        """ Ask the process (and its process group) to stop, with
+        SIGTERM """
+        if self.__terminate_time is None:
+            now = time.time()
+            self.__timed_out = self.has_timed_out(now)
+            self.__terminate_time = now
+        self.send_signal(signal.SIGTERM)
 
     def kill(self):
+        """ Kill the process with SIGKILL, along with its process group,
+        which can outlive the process itself """
+        # Without a group, the pid could have been reused once it exited
+        if self.__process_group or self.is_running():
+            self.send_signal(signal.SIGKILL)
+
+    def get_terminate_time(self):
+        return self.__terminate_time
+
+    def send_signal(self, sig):
+        """ Send a signal to the process' group, if it leads one, or else
+        to the process """
+        if self.__pid is None:
+            return
         try:
-            os.kill(int(self.__pid), signal.SIGTERM)
-        except:
+            if self.__process_group:
+                os.killpg(self.__pid, sig)
+            else:
+                os.kill(self.__pid, sig)
+        except OSError:
             pass
 
+    def is_alive(self):
+        """ Whether the process, or any process in its group, is still
+        running.
 
-class Output:
-    def __init__(self):
-        self.__output = []
+        The process is waited for if it has exited, as a process that
+        hasn't been waited for still counts as running. Its exit status is
+        lost, so this is only for stopping.
+        """
+        try:
+            os.waitpid(self.__pid, os.WNOHANG)
+        except OSError:
+            pass
+        try:
+            if self.__process_group:
+                os.killpg(self.__pid, 0)
+            else:
+                os.kill(self.__pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def set_resource_usage(self, usage):
+        self.__usage = usage
+
+    def get_resource_usage(self):
+        """ Get the ResourceUsage of the finished process, or None if it
+        isn't known """
+        return self.__usage
 
-    def all(self):
+    def output(self):
         return self.__output
 
-    def __len__(self):
-        return len(self.__output)
-
-    def from_line(self, line):
-        return self.__output[line:]
+    def name(self):
+        return "DoOutput(%s)" % self.__id
 
-    def append(self, stdout, stderr):
-        if stdout is not None:
-            self.__output.append(stdout)
-        if stderr is not None:
-            self.__output.append("E> %s" % stderr)
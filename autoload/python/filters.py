@@ -0,0 +1,189 @@
+import re
+import time
+import array
+
+class FilterSpec:
+    """ Which lines of output to show: a kind of filter ("stderr" or
+    "regex"), its pattern, and how many lines of context to show around
+    each matching line. """
+    def __init__(self, kind, pattern = None, context = 0):
+        self.kind = kind
+        self.pattern = pattern
+        self.context = context
+
+    def key(self):
+        """ Filters with the same key share an index """
+        return (self.kind, self.pattern)
+
+    def create(self):
+        if self.kind == "stderr":
+            return StderrFilter()
+        return RegexFilter(self.pattern)
+
+    def __str__(self):
+        s = "stderr" if self.kind == "stderr" else "/%s/" % self.pattern
+        if self.context:
+            s += ", context %i" % self.context
+        return s
+
+
+def parse(args, current):
+    """ Parse the arguments of :DoFilter, given the current FilterSpec.
+
+    Returns the new FilterSpec, or None to turn filtering off.
+    """
+    args = args.strip()
+    context = current.context if current is not None else 0
+    if args in ("", "off"):
+        return None
+    elif args == "stderr":
+        return FilterSpec("stderr", None, context)
+    elif args.startswith("/"):
+        pattern = args[1:-1] if len(args) > 1 and args.endswith("/") \
+                else args[1:]
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise FilterError("Invalid pattern: %s" % str(e))
+        return FilterSpec("regex", pattern, context)
+
+    match = re.match(r"context\s+(\d+)$", args)
+    if match is not None:
+        if current is None:
+            raise FilterError("There is no filter to add context to")
+        return FilterSpec(current.kind, current.pattern,
+                int(match.group(1)))
+    raise FilterError("Unknown filter '%s', use stderr, /pattern/, "
+            "context <lines> or off" % args)
+
+
+class IndexFilter:
+    """ Selects lines of output, keeping the matching line numbers in an
+    index.
+
+    The index is extended as new output arrives, so the output is only
+    ever scanned once. Subclasses say which lines match, with find().
+    """
+    chunk_lines = 10000
+
+    def __init__(self):
+        self.__matches = array.array('L')
+        self.__scanned = 0
+
+    def update(self, output, deadline):
+        """ Scan new lines, in chunks, until the deadline passes """
+        total = len(output)
+        if total < self.__scanned:
+            # The output has been released
+            self.__matches = array.array('L')
+            self.__scanned = 0
+        while self.__scanned < total:
+            start = self.__scanned
+            end = min(start + self.chunk_lines, total)
+            self.__matches.extend(self.find(output, start, end))
+            self.__scanned = end
+            if time.time() >= deadline:
+                break
+
+    def is_complete(self, output):
+        return self.__scanned >= len(output)
+
+    def matches(self, output):
+        return self.__matches
+
+    def find(self, output, start, end):
+        raise NotImplementedError()
+
+
+class StderrFilter(IndexFilter):
+    """ Lines written to stderr, from the stream tags kept by Output """
+    def find(self, output, start, end):
+        return (i for (i, stream)
+                in enumerate(output.streams()[start:end], start)
+                if stream == output.STDERR)
+
+
+class RegexFilter(IndexFilter):
+    """ Lines that match a regex, as the process wrote them, without the
+    prefix of stderr lines """
+    def __init__(self, pattern):
+        IndexFilter.__init__(self)
+        self.__regex = re.compile(pattern)
+
+    def find(self, output, start, end):
+        search = self.__regex.search
+        return (i for (i, line)
+                in enumerate(output.raw_lines(start, end), start)
+                if search(line))
+
+
+class FilteredOutput:
+    """ The lines of an Output that a filter selects, with context.
+
+    Behaves like an Output (with len() and lines()), over an index of the
+    selected line numbers. The index is extended by update() as the filter
+    finds new matches, including context lines after a match that arrive
+    later.
+    """
+    def __init__(self, output, output_filter, context):
+        self.__output = output
+        self.__filter = output_filter
+        self.__context = context
+        self.__indices = array.array('L')
+        # How many of the filter's matches have been added
+        self.__used = 0
+        # Lines before this have been considered
+        self.__covered = 0
+        # Context lines are wanted up to (but not including) this line
+        self.__wanted = 0
+
+    def __len__(self):
+        return len(self.__indices)
+
+    def total(self):
+        """ The number of lines in the unfiltered output """
+        return len(self.__output)
+
+    def update(self, deadline):
+        output = self.__output
+        self.__filter.update(output, deadline)
+        total = len(output)
+        self.__add(self.__covered, min(self.__wanted, total))
+
+        matches = self.__filter.matches(output)
+        context = self.__context
+        for line in matches[self.__used:]:
+            end = line + context + 1
+            self.__add(max(line - context, self.__covered), min(end, total))
+            self.__wanted = max(self.__wanted, end)
+        self.__used = len(matches)
+
+    def is_stale(self):
+        output = self.__output
+        return not self.__filter.is_complete(output) or \
+                self.__used < len(self.__filter.matches(output)) or \
+                self.__covered < min(self.__wanted, len(output))
+
+    def lines(self, start, end):
+        """ Get the selected lines, reading adjacent lines together """
+        result = []
+        first = last = None
+        for line in self.__indices[start:end]:
+            if first is not None and line == last + 1:
+                last = line
+                continue
+            if first is not None:
+                result.extend(self.__output.lines(first, last + 1))
+            first = last = line
+        if first is not None:
+            result.extend(self.__output.lines(first, last + 1))
+        return result
+
+    def __add(self, start, end):
+        if start < end:
+            self.__indices.extend(range(start, end))
+            self.__covered = end
+
+
+class FilterError(Exception):
+    pass
@@ -0,0 +1,375 @@
+import os
+import re
+import zlib
+import time
+import threading
+from utils import log, to_str, to_bytes
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+class HistoryStore:
+    """ A record of finished processes, in an SQLite database.
+
+    Each run is stored with its command, working directory, exit code, start
+    time, duration and its output, compressed. Runs are written by a
+    background thread, so that recording a process costs the caller no more
+    than putting it on a queue. Searches are made on the calling thread,
+    using a separate connection.
+
+    Output is indexed by trigram: the trigrams table lists, for each three
+    character substring of the words in the output, the runs it appears
+    in. A search only reads the runs that have every trigram of the text
+    that the pattern requires (see required_trigrams()). The runs are
+    listed in blocks of consecutive ids, so that adding a run to the index
+    doesn't rewrite a list that grows with the history.
+    """
+    index_block = 64
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            command TEXT,
+            cwd TEXT,
+            exit_code TEXT,
+            started REAL,
+            duration REAL,
+            lines INTEGER,
+            indexed INTEGER,
+            output BLOB);
+        CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+        CREATE TABLE IF NOT EXISTS trigrams (
+            trigram TEXT,
+            block INTEGER,
+            runs TEXT,
+            PRIMARY KEY (trigram, block));
+    """
+
+    def __init__(self, path):
+        if sqlite3 is None:
+            raise HistoryError("Python's sqlite3 module is not available")
+        self.__path = os.path.expanduser(path)
+        self.__queue = queue.Queue(0)
+        self.__writer = None
+        self.__connection = None
+
+    def record(self, command, cwd, exit_code, started, duration, output):
+        """ Queue a run to be written, where output is an OutputSnapshot,
+        which is read by the writer """
+        if self.__writer is None or not self.__writer.is_alive():
+            self.__writer = HistoryWriter(self.__connect, self.__queue)
+            self.__writer.start()
+        self.__queue.put_nowait((command, cwd, exit_code, started, duration,
+            output))
+
+    def recent(self, pattern = None, limit = 100):
+        """ Get the most recent runs, newest first.
+
+        If given, pattern is a substring that the command must contain.
+        Returns a list of HistoryRun.
+        """
+        query = "SELECT id, command, cwd, exit_code, started, duration, " \
+                "lines FROM runs"
+        params = []
+        if pattern:
+            query += " WHERE instr(command, ?) > 0"
+            params.append(pattern)
+        query += " ORDER BY started DESC LIMIT ?"
+        params.append(limit)
+        return [HistoryRun(*row) for row in
+                self.__reader().execute(query, params)]
+
+    def grep(self, pattern, limit = 100):
+        """ Search the output of past runs, newest first, with a regex.
+
+        Returns a list of (HistoryRun, line number, line), stopping once
+        limit lines have been found.
+        """
+        regex = re.compile(pattern)
+        # Most runs won't match at all, so the whole output is checked
+        # first, with ^ and $ matching at the start and end of each line
+        whole = None
+        if "\\A" not in pattern and "\\Z" not in pattern:
+            whole = re.compile(pattern, re.MULTILINE)
+        candidates = self.__candidates(regex)
+        results = []
+        for row in self.__rows(candidates):
+            output = to_str(zlib.decompress(row[7]))
+            if whole is not None and whole.search(output) is None:
+                continue
+            run = HistoryRun(*row[:7])
+            for (number, line) in enumerate(output.split("\n")):
+                if regex.search(line):
+                    results.append((run, number + 1, line))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def stop(self):
+        """ Stop the writer, once it has written every queued run """
+        if self.__writer is not None:
+            self.__queue.put_nowait(None)
+            self.__writer.join()
+            self.__writer = None
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    def __rows(self, candidates):
+        """ Get the rows of runs, newest first, restricted to the ids in
+        candidates unless it is None """
+        connection = self.__reader()
+        columns = "id, command, cwd, exit_code, started, duration, lines, " \
+                "output"
+        if candidates is None:
+            for row in connection.execute("SELECT %s FROM runs "
+                    "ORDER BY started DESC" % columns):
+                yield row
+            return
+        for (run_id,) in connection.execute("SELECT id FROM runs "
+                "ORDER BY started DESC").fetchall():
+            if run_id in candidates:
+                yield connection.execute("SELECT %s FROM runs WHERE id = ?"
+                        % columns, (run_id,)).fetchone()
+
+    def __candidates(self, regex):
+        """ Get the ids of the runs that could match regex, or None if
+        every run has to be searched """
+        trigrams = required_trigrams(regex)
+        if not trigrams:
+            return None
+        connection = self.__reader()
+        candidates = None
+        for trigram in trigrams:
+            runs = set()
+            for (run_ids,) in connection.execute("SELECT runs FROM trigrams "
+                    "WHERE trigram = ?", (trigram,)):
+                runs.update(map(int, run_ids.split()))
+            candidates = runs if candidates is None else candidates & runs
+            if not candidates:
+                break
+        # Runs that were too large to index could match anything
+        candidates.update(run_id for (run_id,) in connection.execute(
+            "SELECT id FROM runs WHERE indexed = 0"))
+        return candidates
+
+    def __reader(self):
+        if self.__connection is None:
+            self.__connection = self.__connect()
+        return self.__connection
+
+    def __connect(self):
+        directory = os.path.dirname(self.__path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        connection = sqlite3.connect(self.__path)
+        connection.text_factory = str
+        connection.executescript(self.schema)
+        # Runs recorded before output was indexed are searched in full
+        columns = [row[1] for row in
+                connection.execute("PRAGMA table_info(runs)")]
+        if "indexed" not in columns:
+            try:
+                connection.execute("ALTER TABLE runs ADD COLUMN indexed "
+                        "INTEGER DEFAULT 0")
+            except sqlite3.OperationalError:
+                # The other connection added it first
+                pass
+        connection.execute("CREATE INDEX IF NOT EXISTS runs_indexed "
+                "ON runs (indexed)")
+        connection.commit()
+        return connection
+
+
+class HistoryWriter(threading.Thread):
+    """ Write runs from a queue to the history database.
+
+    Whatever is on the queue is written in one transaction, so a burst of
+    finished processes costs one commit rather than one each. The thread
+    stops once it takes None from the queue, after writing what came
+    before it.
+    """
+    def __init__(self, connect, queue):
+        self.__connect = connect
+        self.__queue = queue
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        try:
+            connection = self.__connect()
+        except Exception as e:
+            log("Failed to open history database: %s", e)
+            return
+
+        stopped = False
+        while not stopped:
+            runs = [self.__queue.get()]
+            try:
+                while True:
+                    runs.append(self.__queue.get_nowait())
+            except queue.Empty:
+                pass
+            stopped = None in runs
+            self.__write(connection, [run for run in runs if run is not None])
+        connection.close()
+
+    def __write(self, connection, runs):
+        rows = []
+        indexes = []
+        for (command, cwd, exit_code, started, duration, output) in runs:
+            data = to_bytes("\n".join(output.lines()))
+            trigrams = output_trigrams(data)
+            rows.append((command, cwd, exit_code, started, duration,
+                len(output), int(trigrams is not None),
+                sqlite3.Binary(zlib.compress(data))))
+            indexes.append(trigrams or ())
+        try:
+            connection.executemany("INSERT INTO runs (command, cwd, "
+                    "exit_code, started, duration, lines, indexed, output) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            # The runs were given consecutive ids, as the database is
+            # locked until the commit
+            (last_id,) = connection.execute("SELECT max(id) FROM runs") \
+                    .fetchone()
+            postings = {}
+            for (run_id, trigrams) in zip(
+                    range(last_id - len(rows) + 1, last_id + 1), indexes):
+                block = run_id // HistoryStore.index_block
+                for trigram in trigrams:
+                    key = (trigram, block)
+                    postings[key] = postings.get(key, "") + " %i" % run_id
+            connection.executemany("INSERT OR IGNORE INTO trigrams "
+                    "(trigram, block, runs) VALUES (?, ?, '')",
+                    list(postings))
+            connection.executemany("UPDATE trigrams SET runs = runs || ? "
+                    "WHERE trigram = ? AND block = ?",
+                    [(run_ids, trigram, block) for ((trigram, block), run_ids)
+                        in postings.items()])
+            connection.commit()
+        except sqlite3.Error as e:
+            connection.rollback()
+            log("Failed to write %i runs to history database: %s",
+                    len(rows), str(e))
+
+
+# Only the output of runs up to this size is indexed
+max_index_bytes = 16 * 1024 * 1024
+# Output is indexed in chunks, as a regex holds the GIL until it finishes,
+# which would hold up Vim's thread
+index_chunk_bytes = 65536
+index_chunk_words = 10000
+word_regex = re.compile(b"[A-Za-z0-9_]{3,}")
+trigram_regex = re.compile("(?=([A-Za-z0-9_]{3}))")
+# A repeat in a pattern, as Python's re module reads one
+repeat_regex = re.compile(r"\{\d*(,\d*)?\}")
+
+def output_trigrams(data):
+    """ Get the set of trigrams in the words of some output (as bytes),
+    or None if it is too large to index """
+    if len(data) > max_index_bytes:
+        return None
+    words = set()
+    start = 0
+    while start < len(data):
+        # Words don't span lines
+        end = data.find(b"\n", start + index_chunk_bytes)
+        if end == -1:
+            end = len(data)
+        words.update(word_regex.findall(data, start, end))
+        start = end + 1
+
+    words = list(words)
+    trigrams = set()
+    for i in range(0, len(words), index_chunk_words):
+        trigrams.update(trigram_regex.findall(to_str(
+            b" ".join(words[i:i + index_chunk_words]))))
+    return trigrams
+
+def required_trigrams(regex):
+    """ Get the trigrams that the output of a run must contain for a
+    compiled regex to match it.
+
+    They are taken from the runs of word characters in the pattern that
+    every match includes: those outside groups and character classes that
+    aren't made optional by a quantifier. A pattern with an alternation
+    outside a group, or flags that change what a literal matches, has
+    none.
+    """
+    if regex.flags & (re.IGNORECASE | re.VERBOSE):
+        return set()
+    pattern = regex.pattern
+    literals = []
+    current = ""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        i += 1
+        if char == "\\":
+            # An escaped character or a class such as \d
+            i += 1
+        elif char == "[":
+            if pattern[i:i + 1] == "^":
+                i += 1
+            if pattern[i:i + 1] == "]":
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char in "*?":
+            # The last character is optional
+            current = current[:-1]
+        elif char == "{":
+            # A repeat such as {2,5} can make the last character optional,
+            # and its digits aren't literal text. A { that doesn't start
+            # one is literal, but isn't a word character either.
+            repeat = repeat_regex.match(pattern, i - 1)
+            if repeat is not None:
+                current = current[:-1]
+                i = repeat.end()
+        elif char == "|" and depth == 0:
+            return set()
+        elif depth == 0 and (char == "_" or
+                char.isalnum() and ord(char) < 128):
+            current += char
+            continue
+        literals.append(current)
+        current = ""
+    literals.append(current)
+    return set(literal[j:j + 3] for literal in literals
+            for j in range(len(literal) - 2))
+
+
+class HistoryRun:
+    def __init__(self, run_id, command, cwd, exit_code, started, duration,
+            lines):
+        self.id = run_id
+        self.command = command
+        self.cwd = cwd
+        self.exit_code = exit_code
+        self.started = started
+        self.duration = duration
+        self.lines = lines
+
+    def __str__(self):
+        return "%s  %-10s %9s  %s" %(
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.localtime(self.started)),
+                "exited <%s>" % self.exit_code,
+                "%.2fs" % (self.duration / 1000.0),
+                self.command)
+
+
+class HistoryError(Exception):
+    pass
@@ -0,0 +1,79 @@
+import vim
+from pool import ProcessPool, LineBuffer, BackendError
+
+def available():
+    return bool(int(vim.eval('exists("*job_start") || exists("*jobstart")')))
+
+
+class VimJobPool(ProcessPool):
+    """ Run processes as Vim jobs, with job_start() (Vim 8) or jobstart()
+    (Neovim).
+
+    No Python threads are involved: Vim reads the pipes in its own event
+    loop, and the job callbacks in autoload/do.vim pass the output to
+    output(), exited() and closed(). Output is split into lines and put on
+    the output queue in the same form as AsyncProcessReader. As Vim does the
+    reading, it can't be paused, so the "pause" policy is replaced by
+    "headtail".
+    """
+    def __init__(self):
+        ProcessPool.__init__(self, False)
+        self.__jobs = {}
+        # Vim starts each job in a new session, but Neovim doesn't
+        self.process_groups = not int(vim.eval('has("nvim")'))
+
+    def execute(self, cmd):
+        pid = int(vim.eval("do#JobStart('%s')" % cmd.replace("'", "''")))
+        if pid <= 0:
+            raise BackendError("Failed to start job: %s" % cmd)
+        self.__jobs[pid] = VimJob()
+        return pid
+
+    def output(self, pid, index, data):
+        job = self.__jobs.get(pid)
+        if job is None:
+            return
+        lines = job.buffers[index].split(data)
+        if lines:
+            self._put_output(pid, index, lines)
+
+    def exited(self, pid, exit_code):
+        job = self.__jobs.get(pid)
+        if job is not None:
+            job.exit_code = exit_code
+            self.__finish(pid, job)
+
+    def closed(self, pid):
+        job = self.__jobs.get(pid)
+        if job is not None:
+            job.closed = True
+            self.__finish(pid, job)
+
+    def any_running(self):
+        return bool(self.__jobs)
+
+    def cleanup(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def __finish(self, pid, job):
+        """ Report the exit status once the job has exited and all of its
+        output has been read, which can happen in either order """
+        if job.exit_code is None or not job.closed:
+            return
+        del self.__jobs[pid]
+        for (index, buffer) in enumerate(job.buffers):
+            lines = buffer.flush()
+            if lines:
+                self._put_output(pid, index, lines)
+        self._output_q.put_exit(pid, job.exit_code)
+
+
+class VimJob:
+    def __init__(self):
+        # Vim passes the output as strings, which are already decoded
+        self.buffers = [LineBuffer(True), LineBuffer(True)]
+        self.exit_code = None
+        self.closed = False
@@ -0,0 +1,222 @@
+import heapq
+import itertools
+import multiprocessing
+from rendering import format_time
+from pool import BackendError
+from utils import Options, log
+
+class JobQueue:
+    """ Start processes through a ProcessPool, a limited number at a time.
+
+    At most g:do_max_parallel processes are run at once (defaulting to the
+    number of CPUs). Any others wait in a queue, and are started in order
+    of priority (highest first), then in the order they were submitted.
+    """
+    def __init__(self, process_pool):
+        self.__process_pool = process_pool
+        self.__queue = []
+        self.__sequence = itertools.count()
+        self.__running = 0
+
+    def submit(self, process, priority = 0):
+        heapq.heappush(self.__queue,
+                (-priority, next(self.__sequence), process))
+
+    def start_ready(self):
+        """ Start queued processes while there are free slots.
+
+        A process that fails to start doesn't take a slot, and the next one
+        is started instead. Returns a tuple of (started, failed) lists, of
+        (process, pid) and (process, error message).
+        """
+        started = []
+        failed = []
+        limit = self.max_parallel()
+        while self.__queue and self.__running < limit:
+            (_, _, process) = heapq.heappop(self.__queue)
+            try:
+                pid = self.__process_pool.execute(process.get_command())
+            except (BackendError, OSError) as e:
+                log("Failed to start command: %s: %s", process.get_command(),
+                        str(e))
+                failed.append((process, str(e)))
+                continue
+            log("Started command with pid %i: %s", pid,
+                    process.get_command())
+            self.__running += 1
+            started.append((process, pid))
+        return (started, failed)
+
+    def finished(self, process):
+        self.__running -= 1
+
+    def queued(self):
+        return len(self.__queue)
+
+    def clear(self):
+        """ Remove all queued processes, returning them """
+        processes = [process for (_, _, process) in sorted(self.__queue)]
+        self.__queue = []
+        return processes
+
+    @staticmethod
+    def max_parallel():
+        max_parallel = Options.max_parallel()
+        if max_parallel > 0:
+            return max_parallel
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+
+class Batch:
+    """ A group of processes that were submitted together.
+
+    Once they have all finished, the batch can report its wall time against
+    the total time of the individual processes.
+    """
+    def __init__(self, processes):
+        self.__processes = processes
+
+    def has_finished(self):
+        return all(p.has_finished() for p in self.__processes)
+
+    def wall_time(self):
+        start = min(p.get_start_time() for p in self.__processes)
+        end = max(p.get_end_time() for p in self.__processes)
+        return round((end - start) * 1000)
+
+    def total_time(self):
+        return sum(p.get_time() for p in self.__processes)
+
+    def __str__(self):
+        return "Batch of %i commands finished in %s (%s run one at a time)" \
+                %(len(self.__processes), format_time(self.wall_time()),
+                        format_time(self.total_time()))
+
+
+
+class Pipeline:
+    """ A set of named stages, each of which runs a command after the stages
+    it depends on.
+
+    A stage is ready to run as soon as every stage it depends on has exited
+    with status 0, so independent branches run in parallel. If a stage
+    fails, every stage that depends on it (directly or not) is skipped.
+    """
+    def __init__(self, stages):
+        """ Create a pipeline from a list of (name, command, [dependency]) """
+        self.__order = []
+        self.__commands = {}
+        self.__depends = {}
+        for (name, command, depends) in stages:
+            if name in self.__commands:
+                raise PipelineError("Duplicate pipeline stage '%s'" % name)
+            self.__order.append(name)
+            self.__commands[name] = command
+            self.__depends[name] = list(depends)
+
+        for name in self.__order:
+            for dependency in self.__depends[name]:
+                if dependency not in self.__commands:
+                    raise PipelineError("Pipeline stage '%s' depends on "
+                            "unknown stage '%s'" %(name, dependency))
+        self.__sorted = self.__sort_stages()
+
+        self.__processes = {}
+        self.__pending = self.__order[:]
+        self.__skipped = set()
+
+    def stages(self):
+        return [(name, self.__commands[name]) for name in self.__order]
+
+    def attach(self, name, process):
+        self.__processes[name] = process
+
+    def advance(self):
+        """ Work out which waiting stages can now be run or skipped.
+
+        Returns a tuple of (ready, skipped) lists of processes.
+        """
+        ready = []
+        skipped = []
+        changed = True
+        while changed:
+            changed = False
+            for name in self.__pending[:]:
+                depends = self.__depends[name]
+                if any(self.__has_failed(d) for d in depends):
+                    self.__skipped.add(name)
+                    skipped.append(self.__processes[name])
+                elif all(self.__processes[d].succeeded() for d in depends):
+                    ready.append(self.__processes[name])
+                else:
+                    continue
+                self.__pending.remove(name)
+                changed = True
+        return (ready, skipped)
+
+    def has_finished(self):
+        return all(p.has_finished() for p in self.__processes.values())
+
+    def critical_path(self):
+        """ The chain of stages with the longest total run time.
+
+        Returns a tuple of (total_time, [name, ...]).
+        """
+        paths = {}
+        for name in self.__sorted:
+            if name in self.__skipped:
+                continue
+            previous = [paths[d] for d in self.__depends[name] if d in paths]
+            (time, path) = max(previous) if previous else (0, [])
+            paths[name] = (time + self.__processes[name].get_time(),
+                    path + [name])
+        if not paths:
+            return (0, [])
+        return max(paths.values())
+
+    def __str__(self):
+        (time, path) = self.critical_path()
+        stages = ["%s (%s)" %(name,
+            format_time(self.__processes[name].get_time())) for name in path]
+        s = "Pipeline finished, critical path %s: %s" \
+                %(format_time(time), " -> ".join(stages))
+        if self.__skipped:
+            s += ", skipped %s" % ", ".join(n for n in self.__order
+                    if n in self.__skipped)
+        return s
+
+    def __has_failed(self, name):
+        if name in self.__skipped:
+            return True
+        process = self.__processes[name]
+        return process.has_finished() and not process.succeeded()
+
+    def __sort_stages(self):
+        """ Sort stages so that every stage comes after its dependencies """
+        # Stages are visited depth first, and a cycle exists if a stage is
+        # reached again while it is still being visited
+        visiting = set()
+        visited = []
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise PipelineError("Pipeline stage '%s' has a circular "
+                        "dependency" % name)
+            visiting.add(name)
+            for dependency in self.__depends[name]:
+                visit(dependency)
+            visiting.remove(name)
+            visited.append(name)
+
+        for name in self.__order:
+            visit(name)
+        return visited
+
+
+class PipelineError(Exception):
+    pass
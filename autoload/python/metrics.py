@@ -0,0 +1,132 @@
+import json
+import time
+import bisect
+
+class Metrics:
+    """ A registry of counters and histograms, for profiling the plugin.
+
+    Recording is a no-op until the registry is enabled (g:do_metrics), so
+    that instrumenting a hot path costs no more than a function call.
+    """
+    enabled = False
+    counters = {}
+    histograms = {}
+    started = time.time()
+
+    @classmethod
+    def enable(cls, enabled):
+        if enabled and not cls.enabled:
+            cls.reset()
+        cls.enabled = enabled
+
+    @classmethod
+    def reset(cls):
+        cls.counters = {}
+        cls.histograms = {}
+        cls.started = time.time()
+
+    @classmethod
+    def count(cls, name, value = 1):
+        if cls.enabled:
+            cls.counters[name] = cls.counters.get(name, 0) + value
+
+    @classmethod
+    def observe(cls, name, value):
+        if cls.enabled:
+            histogram = cls.histograms.get(name)
+            if histogram is None:
+                histogram = cls.histograms[name] = Histogram()
+            histogram.add(value)
+
+    @classmethod
+    def to_dict(cls):
+        return {
+            "uptime": round(time.time() - cls.started, 3),
+            "counters": dict(cls.counters),
+            "histograms": dict((name, histogram.to_dict())
+                for (name, histogram) in cls.histograms.items())}
+
+    @classmethod
+    def to_json(cls):
+        return json.dumps(cls.to_dict(), indent=2, sort_keys=True)
+
+    @classmethod
+    def report(cls):
+        """ Format the metrics as lines of text """
+        lines = ["Metrics over %.1fs" %(time.time() - cls.started), ""]
+        for name in sorted(cls.counters):
+            lines.append("%-24s %12s" %(name,
+                "{:,}".format(cls.counters[name])))
+        if cls.histograms:
+            lines.append("")
+            lines.append("%-24s %8s %10s %10s %10s %10s" %("", "count",
+                "mean", "p50", "p95", "max"))
+        for name in sorted(cls.histograms):
+            h = cls.histograms[name]
+            lines.append("%-24s %8i %10.2f %10.2f %10.2f %10.2f" %(name,
+                h.count, h.mean(), h.percentile(50), h.percentile(95),
+                h.max))
+        return lines
+
+
+class Histogram:
+    """ A distribution of values, kept in fixed buckets.
+
+    Buckets follow a 1-2-5 series, so memory use is constant and
+    percentiles are accurate to within a bucket. Zero has a bucket of its
+    own, as many measurements (e.g. lines per check) are often zero.
+    """
+    bounds = [0] + [m * 10 ** e for e in range(-2, 8) for m in (1, 2, 5)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return float(self.total) / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """ The upper bound of the bucket holding the given percentile,
+        kept within the smallest and largest values seen """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                if i == len(self.bounds):
+                    return self.max
+                return max(min(self.bounds[i], self.max), self.min)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99)}
+
+
+def count(name, value = 1):
+    if Metrics.enabled:
+        Metrics.count(name, value)
+
+def observe(name, value):
+    if Metrics.enabled:
+        Metrics.observe(name, value)
@@ -0,0 +1,291 @@
+import array
+import bisect
+import mmap
+import tempfile
+from utils import Options, log, to_str, PY3
+
+class Output:
+    """ The output lines of a process.
+
+    Lines are stored as UTF-8 bytes, one after another, with an index of
+    where each line starts, rather than as a string per line. The stream
+    that each line came from is kept in a parallel array of tags, and the
+    "E> " prefix of stderr lines is only added when lines are read.
+
+    Recent lines are kept in memory. Once there are more than
+    g:do_output_memory_lines lines or g:do_output_memory_bytes bytes in
+    memory, the oldest lines are spilled to a SpillFile. Either limit can be
+    disabled by setting it to 0.
+    """
+    STDOUT = 0
+    STDERR = 1
+    stderr_prefix = "E> "
+
+    def __init__(self):
+        self.__recent = MemoryLines()
+        self.__streams = array.array('B')
+        self.__spill = None
+        self.__spilled = 0
+        self.__max_lines = Options.output_memory_lines()
+        self.__max_bytes = Options.output_memory_bytes()
+
+    def all(self):
+        return self.lines(0, len(self))
+
+    def __len__(self):
+        return len(self.__streams)
+
+    def from_line(self, line):
+        return self.lines(line, len(self))
+
+    def lines(self, start, end):
+        """ Get lines for display, with stderr lines prefixed """
+        lines = self.raw_lines(start, end)
+        if not lines:
+            return lines
+        start = max(0, start)
+        streams = self.__streams[start:start + len(lines)]
+        if self.STDERR in streams:
+            prefix = self.stderr_prefix
+            lines = [prefix + line if stream else line
+                    for (line, stream) in zip(lines, streams)]
+        return lines
+
+    def raw_lines(self, start, end):
+        """ Get lines as the process wrote them, without prefixes """
+        length = len(self)
+        start = max(0, min(start, length))
+        end = max(start, min(end, length))
+
+        spilled = self.__spilled
+        if start >= spilled:
+            return self.__recent.lines(start - spilled, end - spilled)
+
+        result = self.__spill.lines(start, min(end, spilled))
+        if end > spilled:
+            result.extend(self.__recent.lines(0, end - spilled))
+        return result
+
+    def streams(self):
+        """ The stream tag (STDOUT or STDERR) of every line """
+        return self.__streams
+
+    def extend(self, lines, stderr = ()):
+        """ Add lines, where stderr is a list of (offset, count) runs of
+        lines in the list that were written to stderr """
+        streams = array.array('B', [self.STDOUT]) * len(lines)
+        for (offset, count) in stderr:
+            streams[offset:offset + count] = \
+                    array.array('B', [self.STDERR]) * count
+        self.__recent.append(lines)
+        self.__streams.extend(streams)
+        self.__spill_excess()
+
+    def extend_encoded(self, data, streams):
+        """ Add lines as returned by OutputSnapshot.encoded(), with the
+        stream tag of each line """
+        end = 0
+        ends = []
+        for line in data.split(b"\n")[:-1]:
+            end += len(line) + 1
+            ends.append(end)
+        self.__recent.append_encoded(data, ends)
+        self.__streams.extend(streams)
+        self.__spill_excess()
+
+    def snapshot(self):
+        """ Get an OutputSnapshot of the lines so far, to read them on
+        another thread once the process has finished """
+        stores = [self.__recent]
+        if self.__spill is not None:
+            stores.insert(0, self.__spill)
+        return OutputSnapshot(stores, self.__streams)
+
+    def release(self):
+        """ Free all stored output.
+
+        The storage is dropped rather than closed, as a snapshot can still
+        be reading it. The spill file is closed when the last reference to
+        it goes.
+        """
+        self.__spill = None
+        self.__recent = MemoryLines()
+        self.__streams = array.array('B')
+        self.__spilled = 0
+
+    def __spill_excess(self):
+        recent = self.__recent
+        count = 0
+        if self.__max_lines and len(recent) > self.__max_lines:
+            # Spill an extra quarter, so that spilling doesn't happen on
+            # every extend
+            count = len(recent) - self.__max_lines * 3 // 4
+
+        if self.__max_bytes and recent.size() > self.__max_bytes:
+            count = max(count, recent.count_within(
+                recent.size() - self.__max_bytes * 3 // 4))
+
+        if count <= 0:
+            return
+
+        if self.__spill is None:
+            self.__spill = SpillFile()
+        (data, ends) = recent.take(count)
+        self.__spill.append_encoded(data, ends)
+        self.__spilled += count
+
+
+class OutputSnapshot:
+    """ The lines of a finished Output, for reading on another thread.
+
+    It keeps the Output's storage alive, so it can still be read after the
+    Output is released.
+    """
+    def __init__(self, stores, streams):
+        self.__stores = stores
+        self.__streams = streams
+
+    def __len__(self):
+        return len(self.__streams)
+
+    def encoded(self):
+        """ Get every line as UTF-8 bytes, each ending in a newline """
+        return b"".join(store.encoded() for store in self.__stores)
+
+    def streams(self):
+        """ The stream tag (STDOUT or STDERR) of every line """
+        return self.__streams
+
+    def lines(self):
+        """ Get every line for display, with stderr lines prefixed """
+        data = self.encoded()
+        if not data:
+            return []
+        lines = to_str(data[:-1]).split("\n")
+        streams = self.__streams
+        if Output.STDERR in streams:
+            prefix = Output.stderr_prefix
+            lines = [prefix + line if stream else line
+                    for (line, stream) in zip(lines, streams)]
+        return lines
+
+
+class LineStore:
+    """ Lines stored one after another as UTF-8 bytes, separated by
+    newlines.
+
+    The offset of the start of every line, and the end of the last line,
+    is kept in an index. Subclasses say where the bytes are kept.
+    """
+    def __init__(self):
+        self._offsets = array.array('L', [0])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def size(self):
+        """ The number of bytes stored """
+        return self._offsets[-1] - self._offsets[0]
+
+    def append(self, lines):
+        if PY3:
+            # Offsets are in bytes
+            lines = [line.encode("utf-8") for line in lines]
+        end = 0
+        ends = []
+        for line in lines:
+            end += len(line) + 1
+            ends.append(end)
+        self.append_encoded(b"\n".join(lines) + b"\n", ends)
+
+    def append_encoded(self, data, ends):
+        """ Add lines that are already encoded and joined, where ends are
+        the offsets in data of the end of each line """
+        if not ends:
+            return
+        self._write(data)
+        last = self._offsets[-1]
+        self._offsets.extend(last + end for end in ends)
+
+    def encoded(self):
+        """ Get every line as UTF-8 bytes, each ending in a newline """
+        return bytes(self._read(0, self.size()))
+
+    def count_within(self, size):
+        """ The number of lines, from the first, that fill size bytes """
+        offsets = self._offsets
+        return min(len(self),
+                bisect.bisect_left(offsets, offsets[0] + size))
+
+    def lines(self, start, end):
+        if start >= end:
+            return []
+        base = self._offsets[0]
+        data = self._read(self._offsets[start] - base,
+                self._offsets[end] - base - 1)
+        if PY3:
+            return data.decode("utf-8").split("\n")
+        return str(data).split("\n")
+
+
+class MemoryLines(LineStore):
+    """ A LineStore in memory, that lines can be taken from the front of """
+    def __init__(self):
+        LineStore.__init__(self)
+        self.__data = bytearray()
+
+    def take(self, count):
+        """ Remove the first count lines, returning them as (data, ends),
+        for append_encoded() """
+        offsets = self._offsets
+        base = offsets[0]
+        size = offsets[count] - base
+        data = self.__data[:size]
+        ends = [offset - base for offset in offsets[1:count + 1]]
+        del self.__data[:size]
+        del offsets[:count]
+        return (data, ends)
+
+    def _write(self, data):
+        self.__data += data
+
+    def _read(self, start, end):
+        return self.__data[start:end]
+
+
+class SpillFile(LineStore):
+    """ An append-only temporary file of output lines, which are read back
+    through mmap """
+    def __init__(self):
+        LineStore.__init__(self)
+        self.__file = tempfile.TemporaryFile(prefix="vim-do-")
+        self.__map = None
+        log("Spilling output to a temporary file")
+
+    def _write(self, data):
+        self.__file.write(data)
+        self.__file.flush()
+
+    def encoded(self):
+        # Through a map of its own, as the shared one is replaced when it
+        # is too small
+        size = self._offsets[-1]
+        if not size:
+            return b""
+        data = mmap.mmap(self.__file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            return data[:]
+        finally:
+            data.close()
+
+    def _read(self, start, end):
+        return self.__mapped()[start:end]
+
+    def __mapped(self):
+        size = self._offsets[-1]
+        if self.__map is None or len(self.__map) < size:
+            if self.__map is not None:
+                self.__map.close()
+            self.__map = mmap.mmap(self.__file.fileno(), size,
+                    access=mmap.ACCESS_READ)
+        return self.__map
@@ -0,0 +1,582 @@
+import threading
+import subprocess
+import shlex
+import select
+import fcntl
+import errno
+import time
+import sys
+import collections
+from utils import Options, log, to_str, PY3
+import os
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# The most to read from a pipe at once
+chunk_size = 65536
+# How long to keep reading after a process has exited, as a backgrounded
+# grandchild can hold its pipes open
+exit_timeout = 0.2
+# How often to check whether paused processes can be read again
+pause_interval = 0.05
+
+def popen(cmd):
+    """ Start a shell command in a new session, which makes it the leader
+    of its own process group, so that it can be killed along with its
+    children """
+    if PY3:
+        session = {"start_new_session": True}
+    else:
+        session = {"preexec_fn": os.setsid}
+    return subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, **session)
+
+
+def reap(process, block = True):
+    """ Wait for a Popen process with os.wait4(), which also gives its
+    resource usage, setting its returncode.
+
+    Returns (exited, usage), where usage is a ResourceUsage, or None if the
+    process had already been waited for elsewhere.
+    """
+    try:
+        (pid, status, rusage) = os.wait4(process.pid,
+                0 if block else os.WNOHANG)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        if process.returncode is None:
+            process.returncode = -1
+        return (True, None)
+    if pid == 0:
+        return (False, None)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return (True, ResourceUsage(rusage))
+
+
+class ResourceUsage:
+    """ The CPU time (in seconds) of a process, including the children that
+    it waited for.
+
+    Its peak resident set size isn't kept: on Linux, ru_maxrss includes the
+    memory inherited from Vim when the process was forked.
+    """
+    def __init__(self, rusage):
+        self.cpu_time = rusage.ru_utime + rusage.ru_stime
+
+
+class OutputQueue:
+    """ The queue of output batches from the process pool to check_now().
+
+    Batches are (pid, None, stdout_lines, stderr_lines), and a process'
+    exit status follows its last batch as (pid, exit_code, None, None).
+
+    Each process can have at most max_lines lines on the queue (0 for no
+    limit). What happens to lines beyond that depends on the policy:
+
+    * "pause": the pool stops reading from the process, asking
+      should_pause(), so that the pipe fills up and blocks the process.
+    * "drop": lines are dropped, and counted.
+    * "headtail": the most recent max_lines lines are kept aside, and the
+      rest are dropped. They are queued when there is room again, or when
+      the process exits, after a line saying how many were dropped.
+    """
+    policies = ("pause", "drop", "headtail")
+
+    def __init__(self, max_lines, policy):
+        self.max_lines = max_lines
+        self.policy = policy
+        self.__queue = queue.Queue(0)
+        self.__lock = threading.Lock()
+        self.__queued = {}
+        self.__dropped = {}
+        self.__tails = {}
+        self.__finished = set()
+        self.__usages = {}
+
+    def put_output(self, pid, stdout, stderr):
+        with self.__lock:
+            self.__flush_tail(pid)
+            if self.max_lines and self.policy != "pause":
+                room = max(0, self.max_lines - self.__queued.get(pid, 0))
+                (stdout, stderr, excess) = self.__split(stdout, stderr, room)
+                if excess:
+                    self.__put_aside(pid, excess)
+            self.__put(pid, stdout, stderr)
+
+    def put_exit(self, pid, exit_code, usage = None):
+        with self.__lock:
+            self.__flush_tail(pid, True)
+            if usage is not None:
+                self.__usages[pid] = usage
+            self.__queue.put_nowait((pid, exit_code, None, None))
+
+    def resource_usage(self, pid):
+        """ Take the ResourceUsage of an exited process, if there is one """
+        with self.__lock:
+            return self.__usages.pop(pid, None)
+
+    def should_pause(self, pid):
+        return self.policy == "pause" and self.__is_full(pid)
+
+    def empty(self):
+        return self.__queue.empty()
+
+    def queued_lines(self):
+        """ The number of lines waiting on the queue, for every process """
+        with self.__lock:
+            return sum(self.__queued.values())
+
+    def get_nowait(self):
+        """ Get the next batch, or raise queue.Empty """
+        batch = self.__queue.get_nowait()
+        (pid, exit_code, stdout, stderr) = batch
+        with self.__lock:
+            if exit_code is not None:
+                self.__queued.pop(pid, None)
+                self.__finished.add(pid)
+            else:
+                self.__queued[pid] -= len(stdout or ()) + len(stderr or ())
+        return batch
+
+    def flush_tails(self):
+        """ Queue lines kept aside, for processes that have room again """
+        with self.__lock:
+            for pid in list(self.__tails):
+                self.__flush_tail(pid)
+
+    def throttle_states(self):
+        """ Get {pid: (throttled, dropped)} for every process that has
+        reached its limit, forgetting those whose exit has been taken from
+        the queue """
+        with self.__lock:
+            pids = set(self.__dropped)
+            pids.update(pid for pid in self.__queued if self.__is_full(pid))
+            states = dict((pid, (self.__is_full(pid),
+                self.__dropped.get(pid, 0))) for pid in pids)
+            for pid in self.__finished:
+                self.__dropped.pop(pid, None)
+            self.__finished = set()
+        return states
+
+    def __is_full(self, pid):
+        return bool(self.max_lines) and \
+                self.__queued.get(pid, 0) >= self.max_lines
+
+    def __put(self, pid, stdout, stderr):
+        count = len(stdout or ()) + len(stderr or ())
+        if count:
+            self.__queued[pid] = self.__queued.get(pid, 0) + count
+            self.__queue.put_nowait((pid, None, stdout, stderr))
+
+    def __put_aside(self, pid, lines):
+        """ Drop lines, or keep them aside for the headtail policy """
+        if self.policy == "drop":
+            self.__dropped[pid] = self.__dropped.get(pid, 0) + len(lines)
+            return
+        tail = self.__tails.get(pid)
+        if tail is None:
+            tail = self.__tails[pid] = [collections.deque(
+                maxlen=self.max_lines), 0]
+        excess = len(tail[0]) + len(lines) - self.max_lines
+        if excess > 0:
+            tail[1] += excess
+            self.__dropped[pid] = self.__dropped.get(pid, 0) + excess
+        tail[0].extend(lines)
+
+    def __flush_tail(self, pid, force = False):
+        tail = self.__tails.get(pid)
+        if tail is None or (not force and self.__is_full(pid)):
+            return
+        del self.__tails[pid]
+        (lines, dropped) = tail
+        if dropped:
+            self.__put(pid, ["... {:,} lines dropped ...".format(dropped)],
+                    None)
+        # Lines were kept in order, so split them into runs by stream
+        run = []
+        index = 0
+        for (line_index, line) in lines:
+            if line_index != index and run:
+                self.__put(pid, *self.__batch(index, run))
+                run = []
+            index = line_index
+            run.append(line)
+        if run:
+            self.__put(pid, *self.__batch(index, run))
+
+    @staticmethod
+    def __batch(index, lines):
+        return (lines, None) if index == 0 else (None, lines)
+
+    @staticmethod
+    def __split(stdout, stderr, room):
+        """ Split a batch into the lines that fit in room, and the rest as
+        (index, line) pairs, where index 0 is stdout and 1 is stderr """
+        stdout = stdout or []
+        stderr = stderr or []
+        if len(stdout) + len(stderr) <= room:
+            return (stdout, stderr, [])
+        excess = [(0, line) for line in stdout[room:]]
+        stderr_room = max(0, room - len(stdout))
+        excess.extend((1, line) for line in stderr[stderr_room:])
+        return (stdout[:room], stderr[:stderr_room], excess)
+
+
+class LineBuffer:
+    """ Split the data read from a pipe into complete lines, keeping any
+    trailing partial line until the rest of it arrives.
+
+    Data is bytes, which are decoded, unless text is True.
+    """
+    def __init__(self, text = False):
+        self.__text = text
+        self.__newline = "\n" if text else b"\n"
+        self.__partial = self.__newline[:0]
+
+    def split(self, data):
+        lines = (self.__partial + data).split(self.__newline)
+        self.__partial = lines.pop()
+        if self.__text:
+            return lines
+        return [to_str(line) for line in lines]
+
+    def flush(self):
+        """ Take the partial line, as a list of no lines or one """
+        partial = self.__partial
+        if not partial:
+            return []
+        self.__partial = self.__newline[:0]
+        return [partial if self.__text else to_str(partial)]
+
+
+class ProcessStreams:
+    """ The stdout and stderr pipes of a single process.
+
+    Each pipe is switched to non-blocking mode and read with os.read(), so a
+    partial line (e.g. a progress bar) never blocks the reader. Complete
+    lines are split out in bulk by a LineBuffer.
+    """
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+        self.fds = [process.stdout.fileno(), process.stderr.fileno()]
+        self.open_fds = self.fds[:]
+        self.exited = False
+        self.usage = None
+        # When both pipes reached EOF
+        self.closed_time = None
+        self.__buffers = [LineBuffer(), LineBuffer()]
+        for fd in self.fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def read(self, fd, output):
+        """ Read a chunk from fd, adding complete lines to output.
+
+        Returns False if there was nothing to read.
+        """
+        ind = self.fds.index(fd)
+        try:
+            data = os.read(fd, chunk_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+
+        if not data:
+            self.open_fds.remove(fd)
+            self.__flush(ind, output)
+            if not self.open_fds:
+                self.closed_time = time.time()
+            return False
+
+        output[ind].extend(self.__buffers[ind].split(data))
+        return True
+
+    def drain(self, output):
+        """ Read everything that is currently buffered in the pipes """
+        for fd in self.open_fds[:]:
+            while self.read(fd, output):
+                pass
+        for ind in range(len(self.fds)):
+            self.__flush(ind, output)
+
+    def is_closed(self):
+        return not self.open_fds
+
+    def has_exited(self):
+        if not self.exited:
+            (self.exited, self.usage) = reap(self.process, False)
+        return self.exited
+
+    def close(self):
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+    def __flush(self, ind, output):
+        output[ind].extend(self.__buffers[ind].flush())
+
+
+class AsyncProcessReader(threading.Thread):
+    """ A single background thread that reads the output of every process.
+
+    All stdout and stderr pipes are watched with one select() call, along
+    with a wakeup pipe used to register new processes. Output is pushed on
+    to the OutputQueue as one batch per process per wakeup. When the queue
+    asks for a process to be paused, its pipes are left out of select()
+    until check_now() has caught up.
+    """
+    # How often to try to reap a process whose pipes have closed, which
+    # usually exits straight after
+    reap_interval = 0.005
+
+    def __init__(self, output_q):
+        self.__output_q = output_q
+        self.__streams = []
+        self.__streams_by_fd = {}
+        self.__new_processes = []
+        self.__lock = threading.Lock()
+        self.__stopped = False
+        self.__last_exit_check = 0
+        (self.__wakeup_r, self.__wakeup_w) = os.pipe()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def add(self, process):
+        with self.__lock:
+            self.__new_processes.append(process)
+        self.__wakeup()
+
+    def stop(self):
+        self.__stopped = True
+        self.__wakeup()
+
+    def any_running(self):
+        with self.__lock:
+            return bool(self.__streams or self.__new_processes)
+
+    def run(self):
+        log("Starting output reader thread")
+        while not self.__stopped:
+            self.__add_new_processes()
+
+            fds = [self.__wakeup_r]
+            paused = False
+            for (fd, streams) in self.__streams_by_fd.items():
+                if self.__output_q.should_pause(streams.pid):
+                    paused = True
+                else:
+                    fds.append(fd)
+            # Time out periodically while processes are running, as a
+            # backgrounded grandchild can hold the pipes open after the
+            # process itself has exited.
+            timeout = exit_timeout if self.__streams else None
+            if paused:
+                timeout = pause_interval
+            if self.__awaiting_exit():
+                timeout = self.reap_interval
+            fdsin, _, _ = select.select(fds, [], [], timeout)
+
+            outputs = {}
+            for fd in fdsin:
+                if fd == self.__wakeup_r:
+                    os.read(self.__wakeup_r, 4096)
+                    continue
+                streams = self.__streams_by_fd[fd]
+                output = outputs.setdefault(streams.pid, [[], []])
+                streams.read(fd, output)
+                if fd not in streams.open_fds:
+                    del self.__streams_by_fd[fd]
+
+            for (pid, output) in outputs.items():
+                if output[0] or output[1]:
+                    self.__output_q.put_output(pid, output[0], output[1])
+
+            self.__check_exited()
+
+        os.close(self.__wakeup_r)
+        os.close(self.__wakeup_w)
+        log("Stopped output reader thread")
+
+    def __add_new_processes(self):
+        with self.__lock:
+            new_processes = self.__new_processes
+            self.__new_processes = []
+            for process in new_processes:
+                streams = ProcessStreams(process)
+                self.__streams.append(streams)
+                for fd in streams.fds:
+                    self.__streams_by_fd[fd] = streams
+
+    def __awaiting_exit(self):
+        """ Whether a process has recently closed its pipes, but hasn't
+        been reaped yet. One that closed them long ago is polled like a
+        running process. """
+        now = time.time()
+        return any(now - streams.closed_time < exit_timeout
+                for streams in self.__streams if streams.is_closed())
+
+    def __check_exited(self):
+        now = time.time()
+        poll = now - self.__last_exit_check >= exit_timeout
+        if poll:
+            self.__last_exit_check = now
+
+        for streams in self.__streams[:]:
+            if streams.is_closed():
+                if streams.has_exited():
+                    self.__finish(streams)
+            elif poll and streams.has_exited():
+                output = [[], []]
+                streams.drain(output)
+                if output[0] or output[1]:
+                    self.__output_q.put_output(streams.pid, output[0],
+                            output[1])
+                self.__finish(streams)
+
+    def __finish(self, streams):
+        with self.__lock:
+            self.__streams.remove(streams)
+        for fd in streams.fds:
+            self.__streams_by_fd.pop(fd, None)
+        streams.close()
+        log("Finished with %i", streams.process.returncode)
+        self.__output_q.put_exit(streams.pid, streams.process.returncode,
+                streams.usage)
+
+    def __wakeup(self):
+        try:
+            os.write(self.__wakeup_w, b"x")
+        except OSError:
+            pass
+
+
+def create(backend):
+    """ Create the process pool for a backend name.
+
+    "job" needs Vim's job_start() or Neovim's jobstart(). "asyncio" needs
+    Python 3.8 or later. "auto" picks the first of these that is
+    available, and the select() based pool otherwise.
+    """
+    import jobpool
+    asyncio_available = sys.version_info >= (3, 8)
+    if backend == "auto":
+        if jobpool.available():
+            backend = "job"
+        elif asyncio_available:
+            backend = "asyncio"
+        else:
+            backend = "select"
+    if backend == "job":
+        if not jobpool.available():
+            raise BackendError("The job backend needs Vim 8 or Neovim")
+        return jobpool.VimJobPool()
+    elif backend == "asyncio":
+        if not asyncio_available:
+            raise BackendError("The asyncio backend needs Python 3.8 or "
+                    "later")
+        import aiopool
+        return aiopool.AsyncioProcessPool()
+    elif backend == "select":
+        return ProcessPool()
+    raise BackendError("Unknown backend '%s'" % backend)
+
+
+class ProcessPool:
+    """ Start processes, and collect their output with an
+    AsyncProcessReader.
+
+    Pools that can't stop reading from a process (can_pause is False) use
+    the "headtail" policy instead of "pause", so that the queue is still
+    limited. Each process leads its own process group, unless
+    process_groups is False.
+    """
+    process_groups = True
+
+    def __init__(self, can_pause = True):
+        self.__reader = None
+        policy = Options.backpressure()
+        if policy == "pause" and not can_pause:
+            log("This backend can't pause processes, using the headtail "
+                    "policy instead")
+            policy = "headtail"
+        self._output_q = OutputQueue(Options.queue_lines(), policy)
+
+    def execute(self, cmd):
+        subproc = popen(cmd)
+        self.__get_reader().add(subproc)
+        return subproc.pid
+
+    def any_running(self):
+        self.cleanup()
+        return self.__reader is not None and self.__reader.any_running()
+
+    def has_output(self):
+        return not self._output_q.empty()
+
+    def queued_lines(self):
+        return self._output_q.queued_lines()
+
+    def get_outputs(self, deadline = None):
+        """ Get queued output batches and exit statuses.
+
+        If a deadline (from time.time()) is given, stop collecting once it
+        has passed and leave the rest on the queue for the next call.
+        """
+        if self._output_q.empty():
+            self._output_q.flush_tails()
+            return []
+
+        results = []
+        try:
+            while deadline is None or time.time() < deadline:
+                results.append(self._output_q.get_nowait())
+        except queue.Empty:
+            pass
+
+        self._output_q.flush_tails()
+        return results
+
+    def resource_usage(self, pid):
+        """ Get the ResourceUsage of an exited process, or None if it isn't
+        known """
+        return self._output_q.resource_usage(pid)
+
+    def _put_output(self, pid, index, lines):
+        """ Queue lines from stdout (index 0) or stderr (index 1) """
+        output = [None, None]
+        output[index] = lines
+        self._output_q.put_output(pid, output[0], output[1])
+
+    def throttle_states(self):
+        """ Get {pid: (throttled, dropped)} for processes that have hit
+        the queue limit """
+        return self._output_q.throttle_states()
+
+    def cleanup(self):
+        if self.__reader is not None and not self.__reader.is_alive():
+            self.__reader = None
+
+    def stop(self):
+        if self.__reader is not None:
+            self.__reader.stop()
+            self.__reader.join(1)
+            self.__reader = None
+
+    def __get_reader(self):
+        self.cleanup()
+        if self.__reader is None:
+            self.__reader = AsyncProcessReader(self._output_q)
+            self.__reader.start()
+        return self.__reader
+
+
+class BackendError(Exception):
+    pass
@@ -0,0 +1,240 @@
+import re
+import time
+from utils import log
+
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+
+class ErrorFormat:
+    """ A Vim 'errorformat' compiled to Python regular expressions.
+
+    Each single-line format is supported, along with the %E, %W, %I and %A
+    prefixes (whose continuation lines are ignored) and %-G to ignore lines.
+    Formats using the other prefixes (continuation, directory and file
+    stack) are skipped.
+
+    For speed, the formats are joined into as few alternations as possible,
+    so that most lines are matched with a single regex call.
+    """
+    conversions = {
+        "f": ("filename", r"(.+?)"),
+        "l": ("lnum", r"(\d+)"),
+        "c": ("col", r"(\d+)"),
+        "v": ("vcol", r"(\d+)"),
+        "n": ("nr", r"(\d+)"),
+        "t": ("type", r"(.)"),
+        "m": ("text", r"(.+)"),
+        "r": ("text", r"(.*)"),
+        "p": ("pointer", r"([-. \t]*)"),
+        "s": ("pattern", r"(.+)"),
+    }
+    literals = {".": ".", "#": "*", "^": "^", "$": "$", "[": "[",
+            "~": "~", "%": "%", "\\": "\\"}
+    supported_prefixes = "EWIAG"
+    # Python 2's re module allows at most 100 groups per pattern
+    max_groups = 99
+
+    def __init__(self, errorformat):
+        self.__regexes = []
+        skipped = 0
+        patterns = []
+        for item in split_errorformat(errorformat):
+            pattern = self.__compile(item)
+            if pattern is None:
+                skipped += 1
+            else:
+                patterns.append(pattern)
+        if skipped:
+            log("Skipped %i unsupported errorformat items", skipped)
+
+        # Each format is wrapped in a group, and as that group closes last,
+        # the match's lastindex says which format matched
+        alternatives = []
+        formats = {}
+        groups = 0
+        for (regex, fields, entry_type, ignore) in patterns:
+            if groups + len(fields) + 1 > self.max_groups:
+                self.__add_regex(alternatives, formats)
+                alternatives = []
+                formats = {}
+                groups = 0
+            formats[groups + 1] = (fields, entry_type, ignore)
+            alternatives.append(r"(%s\Z)" % regex)
+            groups += len(fields) + 1
+        self.__add_regex(alternatives, formats)
+
+    def match(self, line):
+        """ Match a line against the formats.
+
+        Returns a quickfix entry dict, or None if the line doesn't match or
+        is ignored.
+        """
+        for (regex, formats) in self.__regexes:
+            match = regex.match(line)
+            if match is not None:
+                break
+        else:
+            return None
+
+        index = match.lastindex
+        (fields, entry_type, ignore) = formats[index]
+        if ignore:
+            return None
+        entry = {"valid": 1}
+        if entry_type:
+            entry["type"] = entry_type
+        values = match.groups()[index:index + len(fields)]
+        for (field, value) in zip(fields, values):
+            if field in ("lnum", "col", "nr"):
+                entry[field] = int(value)
+            elif field == "vcol":
+                entry["col"] = int(value)
+                entry["vcol"] = 1
+            elif field == "pointer":
+                entry["col"] = len(value.expandtabs(8)) + 1
+                entry["vcol"] = 1
+            elif field != "pattern":
+                entry[field] = value
+        return entry
+
+    def __add_regex(self, alternatives, formats):
+        if alternatives:
+            self.__regexes.append((re.compile("|".join(alternatives)),
+                formats))
+
+    def __compile(self, item):
+        entry_type = None
+        ignore = False
+        prefix = re.match(r"%([-+]?)([A-Z])", item)
+        if prefix is not None:
+            if prefix.group(2) not in self.supported_prefixes:
+                return None
+            if prefix.group(2) == "G":
+                if prefix.group(1) != "-":
+                    return None
+                ignore = True
+            elif prefix.group(2) != "A":
+                entry_type = prefix.group(2)
+            item = item[prefix.end():]
+
+        regex = ""
+        fields = []
+        i = 0
+        while i < len(item):
+            char = item[i]
+            i += 1
+            if char == "\\" and i < len(item):
+                regex += re.escape(item[i])
+                i += 1
+            elif char != "%":
+                regex += re.escape(char)
+            elif i >= len(item):
+                return None
+            else:
+                code = item[i]
+                i += 1
+                if code in self.conversions:
+                    (field, pattern) = self.conversions[code]
+                    fields.append(field)
+                    regex += pattern
+                elif code in self.literals:
+                    regex += self.literals[code]
+                elif code == "*":
+                    # A scanf-style conversion that isn't kept, e.g. %*\d
+                    end = item.find("]", i) + 1 if item[i:i + 1] == "[" \
+                            else i + 2
+                    if end <= i:
+                        return None
+                    regex += "(?:%s)+" % item[i:end]
+                    i = end
+                else:
+                    return None
+
+        try:
+            re.compile(regex)
+        except re.error as e:
+            log("Invalid errorformat item %s: %s", item, e)
+            return None
+        return (regex, fields, entry_type, ignore)
+
+
+class QuickfixParser:
+    """ Parse a process' output into quickfix entries as it arrives.
+
+    Output is read from the process' Output, from where the last call to
+    parse() finished, so that a burst of output can be spread over several
+    checks.
+    """
+    chunk_lines = 1000
+
+    def __init__(self, process, errorformat):
+        self.__process = process
+        self.__format = ErrorFormat(errorformat)
+        self.__parsed_line = 0
+
+    def process(self):
+        return self.__process
+
+    def parse(self, deadline):
+        """ Parse new lines of output, in chunks, until the deadline passes.
+
+        Returns a list of new quickfix entries.
+        """
+        output = self.__process.output()
+        match = self.__format.match
+        entries = []
+        while self.__parsed_line < len(output):
+            end = self.__parsed_line + self.chunk_lines
+            for line in output.raw_lines(self.__parsed_line, end):
+                entry = match(line)
+                if entry is not None:
+                    entries.append(entry)
+            self.__parsed_line = min(end, len(output))
+            if time.time() >= deadline:
+                break
+        return entries
+
+    def has_pending_output(self):
+        return self.__parsed_line < len(self.__process.output())
+
+    def has_finished(self):
+        return self.__process.has_finished() and \
+                not self.has_pending_output()
+
+
+def split_errorformat(errorformat):
+    """ Split an 'errorformat' value on commas that aren't escaped """
+    items = []
+    current = ""
+    i = 0
+    while i < len(errorformat):
+        char = errorformat[i]
+        if char == "\\" and errorformat[i + 1:i + 2] == ",":
+            current += ","
+            i += 2
+            continue
+        if char == ",":
+            if current:
+                items.append(current)
+            current = ""
+        else:
+            current += char
+        i += 1
+    if current:
+        items.append(current)
+    return items
+
+
+def to_vim(value):
+    """ Convert a Python value to a Vim expression """
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join("%s: %s" %(to_vim(k), to_vim(v))
+                for (k, v) in value.items())
+    elif isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(to_vim(v) for v in value)
+    elif isinstance(value, integer_types):
+        return str(value)
+    else:
+        return "'%s'" % str(value).replace("'", "''")
@@ -1,21 +1,40 @@
 import window
+import time
+import filters
+import metrics
+import collections
 from utils import Options, log
 
 class ProcessRenderer:
+    # The first process row in the command window, after the header
+    first_process_line = 4
+    # How many filter indexes to keep per process
+    max_filters = 8
+
     def __init__(self):
         self.__command_window = window.CommandWindow()
         self.__command_window.write(CommandWindowHeaderFormat())
         self.__command_window_line_maps = {}
         self.__command_window_line_map_order = []
+        self.__command_window_rows = {}
 
         self.__process_window = window.ProcessWindow()
+        self.__process_window_header = []
         self.__process_window_output_line = 0
+        self.__process_window_output_count = 0
         self.__process_window_process = None
+        self.__process_window_filtered = None
+
+        self.__filter = None
+        self.__filters = {}
 
-    def get_pid_by_line_number(self, lineno):
+    def get_id_by_line_number(self, lineno):
         try:
             # Account for header
-            return self.__command_window_line_map_order[lineno - 4]
+            index = lineno - self.first_process_line
+            if index < 0:
+                return None
+            return self.__command_window_line_map_order[index]
         except IndexError:
             return None
 
@@ -23,37 +42,180 @@ class ProcessRenderer:
         if not quiet and Options.auto_show_process_window():
             self.show_process(process)
 
-        (first_line, _) = self.__command_window.write(CommandWindowProcessFormat(process))
-        self.__command_window_line_maps[process.get_pid()] = first_line + 1
-        self.__command_window_line_map_order.append(process.get_pid())
+        row = str(CommandWindowProcessFormat(process))
+        (first_line, _) = self.__command_window.write(row)
+        self.__command_window_line_maps[process.get_id()] = first_line + 1
+        self.__command_window_line_map_order.append(process.get_id())
+        self.__command_window_rows[process.get_id()] = row
+
+    def remove_processes(self, processes):
+        """ Remove the command window rows of the given processes """
+        if not processes:
+            return
+        process_ids = set(p.get_id() for p in processes)
+        lines = sorted((self.__command_window_line_maps[process_id]
+            for process_id in process_ids), reverse=True)
+        for line in lines:
+            self.__command_window.delete(line - 1)
+        for process_id in process_ids:
+            del self.__command_window_rows[process_id]
+            self.__filters.pop(process_id, None)
+
+        self.__command_window_line_map_order = [process_id for process_id
+                in self.__command_window_line_map_order
+                if process_id not in process_ids]
+        self.__command_window_line_maps = dict(
+                (process_id, i + self.first_process_line) for (i, process_id)
+                in enumerate(self.__command_window_line_map_order))
+
+        if self.__process_window_process in processes:
+            self.__process_window_process = None
+            self.__process_window_filtered = None
+
+    def get_filter(self):
+        return self.__filter
+
+    def set_filter(self, spec):
+        """ Filter the process window output with a FilterSpec, or None
+        to show all output, and redraw it """
+        self.__filter = spec
+        if self.__process_window_process is not None:
+            self.show_process(self.__process_window_process)
 
     def show_process(self, process):
-        log("showing process output: %s" % process.get_pid())
+        log("showing process output: %s", process.get_command())
         self.__process_window_process = process
+        self.__process_window_filtered = self.__filtered_output(process)
 
         self.__process_window.clean()
         self.__process_window_output_line = 0
+        self.__process_window_output_count = 0
         self.__process_window.create(Options.new_process_window_command())
 
-        self.__process_window.write(ProcessWindowHeaderFormat(process))
-        self.__write_output(process.output().all())
+        header = str(ProcessWindowHeaderFormat(process, self.__filter)) \
+                .split("\n")
+        self.__process_window.write(header)
+        self.__process_window_header = header
+
+        follow_tail = Options.follow_tail()
+        if follow_tail:
+            self.__update_filtered_output()
+            self.__process_window_output_line = max(0,
+                    len(self.__displayed_output()) - follow_tail)
+        self.render_output()
+
+    def __filtered_output(self, process):
+        """ Get a view of the process' output for the current filter.
+
+        The filter's index is kept between calls, so that switching between
+        filters doesn't scan the output again.
+        """
+        if self.__filter is None:
+            return None
+        indexes = self.__filters.setdefault(process.get_id(),
+                collections.OrderedDict())
+        key = self.__filter.key()
+        output_filter = indexes.pop(key, None)
+        if output_filter is None:
+            output_filter = self.__filter.create()
+        indexes[key] = output_filter
+        while len(indexes) > self.max_filters:
+            indexes.popitem(False)
+        return filters.FilteredOutput(process.output(), output_filter,
+                self.__filter.context)
+
+    def __displayed_output(self):
+        """ The output, or filtered output, shown in the process window """
+        if self.__process_window_filtered is not None:
+            return self.__process_window_filtered
+        return self.__process_window_process.output()
+
+    def __update_filtered_output(self):
+        if self.__process_window_filtered is not None:
+            self.__process_window_filtered.update(time.time() +
+                    Options.check_budget() / 1000.0)
+
+    def update_processes(self, processes):
+        """ Rewrite the command window rows and process window header.
+
+        Only rows whose text has changed since they were last written are
+        rewritten, and adjacent rows are written together.
+        """
+        changed_rows = []
+        for process in processes:
+            process_id = process.get_id()
+            row = str(CommandWindowProcessFormat(process))
+            if self.__command_window_rows.get(process_id) != row:
+                self.__command_window_rows[process_id] = row
+                lineno = self.__command_window_line_maps[process_id]
+                changed_rows.append((lineno, row))
+
+        for (lineno, rows) in contiguous_runs(changed_rows):
+            self.__command_window.overwrite(rows, lineno, True)
 
-    def __write_output(self, output):
-        (first, last) = self.__process_window.write(output)
-        self.__process_window_output_line += last - first
+        if self.__process_window_process in processes:
+            process = self.__process_window_process
+            log("updating process output: %s, %s",
+                    process.get_pid(), process.get_status())
+            self.__update_process_window_header(process)
 
-    def update_process(self, process):
-        self.__command_window.overwrite(CommandWindowProcessFormat(process),
-                self.__command_window_line_maps[process.get_pid()],
-                True)
+    def __update_process_window_header(self, process):
+        header = str(ProcessWindowHeaderFormat(process, self.__filter)) \
+                .split("\n")
+        changed_rows = [(i + 1, row) for (i, row) in enumerate(header)
+                if row != self.__process_window_header[i]]
+        for (lineno, rows) in contiguous_runs(changed_rows):
+            self.__process_window.overwrite(rows, lineno, True)
+        self.__process_window_header = header
 
-        if self.__process_window_process == process:
-            log("updating process output: %s, %s"
-                    %(process.get_pid(),process.get_status()))
-            self.__write_output(process.output().from_line(self.__process_window_output_line))
+    def has_pending_output(self):
+        if self.__process_window_process is None:
+            return False
+        filtered = self.__process_window_filtered
+        if filtered is not None and filtered.is_stale():
+            return True
+        return self.__process_window_output_line < \
+                len(self.__displayed_output())
 
-            self.__process_window.overwrite(ProcessWindowHeaderFormat(process),
-                    1, True)
+    def render_output(self):
+        """ Write the next lines of output to the process window.
+
+        At most g:do_render_lines_per_check lines are written per call, and
+        the rest are left for later calls. In follow tail mode only the last
+        g:do_follow_tail lines are kept in the window.
+        """
+        if not self.has_pending_output():
+            return
+
+        started = time.time()
+        self.__update_filtered_output()
+        output = self.__displayed_output()
+        follow_tail = Options.follow_tail()
+        start = self.__process_window_output_line
+        end = len(output)
+        if follow_tail and end - start > follow_tail:
+            # Skip lines that would be removed straight away
+            start = end - follow_tail
+        end = min(end, start + Options.render_lines_per_check())
+        if start >= end:
+            # The filter has found nothing new yet
+            return
+
+        (first, last) = self.__process_window.write(output.lines(start, end))
+        self.__process_window_output_line = end
+        self.__process_window_output_count += last - first
+
+        if follow_tail and self.__process_window_output_count > follow_tail:
+            excess = self.__process_window_output_count - follow_tail
+            header_lines = len(self.__process_window_header)
+            self.__process_window.delete(header_lines, header_lines + excess)
+            self.__process_window_output_count = follow_tail
+
+        render_time = (time.time() - started) * 1000
+        metrics.observe("render_time_ms", render_time)
+        metrics.count("lines_rendered", last - first)
+        log("Rendered %i lines of output in %.2fms, %i pending",
+                last - first, render_time, len(output) - end)
 
 
     def toggle_command_window(self):
@@ -66,15 +228,52 @@ class ProcessRenderer:
         self.__process_window.destroy()
 
 
+def format_time(time):
+    """ Format a time in milliseconds for display """
+    if time > 1000.0:
+        time = round(time / 1000.0, 2)
+        unit = "s"
+    else:
+        unit = "ms"
+    return "{:,}".format(time) + unit
+
+
+def format_count(count):
+    """ Format a count for display, e.g. 1.2M """
+    for (size, unit) in ((1000000000, "G"), (1000000, "M"), (1000, "k")):
+        if count >= size:
+            return "%.1f%s" %(count / float(size), unit)
+    return str(count)
+
+
+def contiguous_runs(rows):
+    """ Group (lineno, text) pairs into runs of adjacent lines.
+
+    Returns a list of (first_lineno, [text, ...]).
+    """
+    runs = []
+    for (lineno, text) in sorted(rows):
+        if runs and runs[-1][0] + len(runs[-1][1]) == lineno:
+            runs[-1][1].append(text)
+        else:
+            runs.append((lineno, [text]))
+    return runs
+
+
 class ProcessWindowHeaderFormat:
-    def __init__(self, process):
+    def __init__(self, process, output_filter = None):
         self.__process = process
+        self.__filter = output_filter
 
     def __str__(self):
-        values = (self.__process.get_command(),
+        command = self.__process.get_command()
+        if self.__process.get_stage() is not None:
+            command = "%s: %s" %(self.__process.get_stage(), command)
+        values = (command,
                 self.__process.get_status(),
                 self.__formatted_time(),
-                self.__process.get_pid())
+                str(self.__process.get_pid() or "-"),
+                str(self.__filter))
         max_length = max(map(len, values)) + 12
 
         title = "=" * max_length + "\n"
@@ -82,17 +281,18 @@ class ProcessWindowHeaderFormat:
         title += "  [status] %s\n" % values[1]
         title += "    [time] %s\n" % values[2]
         title += "     [pid] %s\n" % values[3]
+        if self.__filter is not None:
+            title += "  [filter] %s\n" % values[4]
         title += "=" * max_length
         return title
 
     def __formatted_time(self):
-        time = self.__process.get_time()
-        if time > 1000.0:
-            time = round(time / 1000.0, 2)
-            unit = "s"
-        else:
-            unit = "ms"
-        return "{:,}".format(time) + unit
+        formatted = format_time(self.__process.get_time())
+        usage = self.__process.get_resource_usage()
+        if usage is not None:
+            formatted += " (cpu %s)" % format_time(
+                    int(round(usage.cpu_time * 1000)))
+        return formatted
 
 
 class CommandWindowHeaderFormat:
@@ -112,8 +312,15 @@ class CommandWindowProcessFormat:
     def __str__(self):
         s = ""
         cmd = self.__process.get_command()
+        status = self.__process.get_status()
+        stage = self.__process.get_stage()
+        if stage is not None:
+            cmd = "%s: %s" %(stage, cmd)
+            if self.__process.get_start_time() is not None and \
+                    self.__process.has_finished():
+                status += " in " + format_time(self.__process.get_time())
         cmd = cmd if len(cmd) <= 30 else cmd[:27] + "..."
-        s += " %-7s | %-51s | %s" %(self.__process.get_pid(), cmd,
-            self.__process.get_status())
+        s += " %-7s | %-51s | %s" %(self.__process.get_pid() or "-", cmd,
+            status)
         return s
 
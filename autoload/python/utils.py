@@ -1,20 +1,69 @@
+from __future__ import print_function
 import time
 import sys
 import os
 import vim
 
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+    def to_str(data):
+        """ Decode bytes read from a process or file """
+        return data.decode("utf-8", "replace")
+
+    def to_bytes(string):
+        return string.encode("utf-8")
+else:
+    def to_str(data):
+        return data
+
+    def to_bytes(string):
+        return string
+
 class Options:
     instance = None
 
     def __init__(self):
-        self.refresh_key = vim.eval('do#get("do_refresh_key")')
-        self.update_time = int(vim.eval("do#get('do_update_time')"))
-        self.new_process_window_command = vim.eval('do#get("do_new_process_window_command")')
-        self.auto_show_process_window = bool(int(vim.eval('do#get("do_auto_show_process_window")')))
-        self.check_interval = int(vim.eval("do#get('do_check_interval')"))
-
-        if self.check_interval < 500:
-            self.check_interval = 500
+        # Options are fetched together, as each vim.eval() has a cost
+        options = vim.eval("do#options()")
+        self.refresh_key = options["do_refresh_key"]
+        self.update_time = int(options["do_update_time"])
+        self.new_process_window_command = options["do_new_process_window_command"]
+        self.auto_show_process_window = bool(int(options["do_auto_show_process_window"]))
+        self.check_interval = int(options["do_check_interval"])
+        self.use_timers = bool(int(vim.eval('has("timers")'))) and \
+                bool(int(options["do_use_timers"]))
+        self.check_budget = int(options["do_check_budget"])
+        self.max_parallel = int(options["do_max_parallel"])
+        self.quickfix = bool(int(options["do_quickfix"]))
+        self.render_lines_per_check = int(options["do_render_lines_per_check"])
+        self.follow_tail = int(options["do_follow_tail"])
+        self.output_memory_lines = int(options["do_output_memory_lines"])
+        self.output_memory_bytes = int(options["do_output_memory_bytes"])
+        self.keep_finished = int(options["do_keep_finished"])
+        self.keep_minutes = int(options["do_keep_minutes"])
+        self.keep_output_lines = int(options["do_keep_output_lines"])
+        self.cache_dir = options["do_cache_dir"]
+        self.cache_size = int(options["do_cache_size"])
+        self.history_file = options["do_history_file"]
+        self.metrics = bool(int(options["do_metrics"]))
+        self.backend = options["do_backend"]
+        self.queue_lines = int(options["do_queue_lines"])
+        self.backpressure = options["do_backpressure"]
+        self.timeout = float(options["do_timeout"])
+        self.kill_grace = int(options["do_kill_grace"])
+
+        if self.render_lines_per_check < 1:
+            self.render_lines_per_check = 1
+        if self.backpressure not in ("pause", "drop", "headtail"):
+            self.backpressure = "pause"
+
+        self.check_interval_min = int(options["do_check_interval_min"])
+
+        if self.check_interval_min < 1:
+            self.check_interval_min = 1
+        if self.check_interval < self.check_interval_min:
+            self.check_interval = self.check_interval_min
 
     @classmethod
     def reload(cls):
@@ -36,6 +85,90 @@ class Options:
     def check_interval(cls):
         return cls.inst().check_interval
 
+    @classmethod
+    def check_interval_min(cls):
+        return cls.inst().check_interval_min
+
+    @classmethod
+    def use_timers(cls):
+        return cls.inst().use_timers
+
+    @classmethod
+    def quickfix(cls):
+        return cls.inst().quickfix
+
+    @classmethod
+    def max_parallel(cls):
+        return cls.inst().max_parallel
+
+    @classmethod
+    def check_budget(cls):
+        return cls.inst().check_budget
+
+    @classmethod
+    def render_lines_per_check(cls):
+        return cls.inst().render_lines_per_check
+
+    @classmethod
+    def follow_tail(cls):
+        return cls.inst().follow_tail
+
+    @classmethod
+    def output_memory_lines(cls):
+        return cls.inst().output_memory_lines
+
+    @classmethod
+    def output_memory_bytes(cls):
+        return cls.inst().output_memory_bytes
+
+    @classmethod
+    def keep_finished(cls):
+        return cls.inst().keep_finished
+
+    @classmethod
+    def keep_minutes(cls):
+        return cls.inst().keep_minutes
+
+    @classmethod
+    def keep_output_lines(cls):
+        return cls.inst().keep_output_lines
+
+    @classmethod
+    def cache_dir(cls):
+        return cls.inst().cache_dir
+
+    @classmethod
+    def cache_size(cls):
+        return cls.inst().cache_size
+
+    @classmethod
+    def history_file(cls):
+        return cls.inst().history_file
+
+    @classmethod
+    def metrics(cls):
+        return cls.inst().metrics
+
+    @classmethod
+    def backend(cls):
+        return cls.inst().backend
+
+    @classmethod
+    def queue_lines(cls):
+        return cls.inst().queue_lines
+
+    @classmethod
+    def backpressure(cls):
+        return cls.inst().backpressure
+
+    @classmethod
+    def timeout(cls):
+        return cls.inst().timeout
+
+    @classmethod
+    def kill_grace(cls):
+        return cls.inst().kill_grace
+
     @classmethod
     def update_time(cls):
         return cls.inst().update_time
@@ -95,7 +228,7 @@ class FileLogger(Logger):
     def __open(self):
         try:
             self.f = open(self.filename,'w')
-        except IOError, e:
+        except IOError as e:
             raise LogError("Invalid file name '%s' for log file: %s" \
                     %(self.filename, str(e)))
         except:
@@ -119,39 +252,58 @@ class FileLogger(Logger):
 class Log:
 
     loggers = {}
+    # The most verbose level of any logger, or -1 if there are none
+    level = -1
 
     def __init__(self,string,level = Logger.INFO):
         Log.log(string,level)
 
     @classmethod
     def log(cls, string, level = Logger.INFO):
-        for k, l in cls.loggers.iteritems():
+        for k, l in cls.loggers.items():
             l.log(string,level)
 
+    @classmethod
+    def update_level(cls):
+        cls.level = max([l.debug_level for l in cls.loggers.values()] + [-1])
+
     @classmethod
     def set_logger(cls, logger):
         k = logger.__class__.__name__
         if k in cls.loggers:
             cls.loggers[k].shutdown()
         cls.loggers[k] = logger
+        cls.update_level()
 
     @classmethod
     def remove_logger(cls, type):
         if type in cls.loggers:
-            cls.loggers[type].shutdown()
+            cls.loggers.pop(type).shutdown()
+            cls.update_level()
             return True
         else:
-            print "Failed to find logger %s in list of loggers" % type
+            print("Failed to find logger %s in list of loggers" % type)
             return False
 
     @classmethod
     def shutdown(cls):
-        for k, l in cls.loggers.iteritems():
+        for k, l in list(cls.loggers.items()):
             l.shutdown()
         cls.loggers = {}
+        cls.level = -1
 
 class LogError(Exception):
     pass
 
-def log(string, level = Logger.INFO):
+def log(string, *args, **kwargs):
+    """ Log a message, if any logger would write it.
+
+    Any args are interpolated into the string with %, but only after the
+    level is checked, so that a disabled log call is cheap.
+    """
+    level = kwargs.get("level", Logger.INFO)
+    if level > Log.level:
+        return
+    if args:
+        string = string % args
     Log.log(string, level)
@@ -12,7 +12,7 @@ class Window():
 
     def toggle(self, open_cmd):
         if self.is_open:
-            self.destroy()
+            self.close()
         else:
             self.create(open_cmd)
 
@@ -37,43 +37,60 @@ class Window():
         self.command('set winheight=%i' % height)
 
     def write(self, msg, overwrite = False):
-        return self._buffer.write(msg, overwrite)
+        return self.__get_buffer().write(msg, overwrite)
 
     def overwrite(self, msg, lineno, allowEmpty = False):
-        return self._buffer.overwrite(msg, lineno, allowEmpty)
+        return self.__get_buffer().overwrite(msg, lineno, allowEmpty)
 
     def delete(self, start_line, end_line = None):
-        self._buffer.delete(start_line, end_line)
+        self.__get_buffer().delete(start_line, end_line)
 
     def line_at(self, line):
-        return self._buffer.line(line)
+        return self.__get_buffer().line(line)
 
     def create(self, open_cmd):
-        """ create window """
+        """ create window
+
+        Once the window has been opened, its Vim buffer is kept (hidden)
+        when the window is closed, so reopening it doesn't copy any lines.
+        """
         if self.is_open:
             return
+        buffer = self.__get_buffer()
         vim.command('silent %s %s' %(open_cmd, self.name))
-        vim.command("setlocal buftype=nofile modifiable "+ \
-                "winfixheight winfixwidth")
-        existing_content = self._buffer.contents()
-        self._buffer = VimBuffer(vim.buffers[self.getbuffernr()])
-        self._buffer.replace(existing_content)
+        vim.command("setlocal buftype=nofile bufhidden=hide noswapfile "+ \
+                "modifiable winfixheight winfixwidth")
+        if not isinstance(buffer, VimBuffer):
+            self._buffer = VimBuffer(vim.buffers[self.getbuffernr()])
+            self._buffer.replace(buffer.contents())
         self.is_open = True
         self.creation_count += 1
 
         self.on_create()
 
-    def destroy(self, wipeout = True):
-        """ destroy window """
+    def close(self):
+        """ close window, keeping its buffer """
+        winnr = self.getwinnr()
+        if self.is_open and winnr != -1:
+            vim.command('silent! %iclose' % winnr)
+        self.destroy()
+
+    def destroy(self, wipeout = False):
+        """ mark the window as closed
+
+        Its buffer is kept, hidden, so that output can still be written to
+        it, unless wipeout is given.
+        """
         if not self.is_open:
             return
         self.on_destroy()
         self.is_open = False
-        self._buffer = HiddenBuffer(self._buffer.contents())
-        self._buffernr = None
-        if wipeout and int(vim.eval('buffer_exists("%s")' % self.name)) == 1:
-            vim.command('bwipeout %s' % self.name)
-            log("Wiped out buffer %s" % self.name)
+        if wipeout:
+            self._buffer = HiddenBuffer(self._buffer.contents())
+            self._buffernr = None
+            if int(vim.eval('buffer_exists("%s")' % self.name)) == 1:
+                vim.command('bwipeout %s' % self.name)
+                log("Wiped out buffer %s", self.name)
 
     def clean(self):
         """ clean all data in buffer """
@@ -89,6 +106,14 @@ class Window():
     def on_create(self):
         pass
 
+    def __get_buffer(self):
+        if not self._buffer.is_valid():
+            # The buffer has been wiped out from outside vim-do
+            log("Lost buffer %s", self.name)
+            self._buffer = HiddenBuffer()
+            self._buffernr = None
+        return self._buffer
+
     def on_destroy(self):
         pass
 
@@ -116,3 +141,25 @@ class CommandWindow(Window):
         self.command('setlocal syntax=do_command_window')
         self.command('nnoremap <buffer> <cr> '+\
                 ':call do#ShowProcessFromCommandWindow()<CR>')
+
+
+class HistoryWindow(Window):
+    name = "DoHistory"
+
+    def on_create(self):
+        if self.creation_count == 1:
+            cmd = 'silent! au BufWinLeave %s' % self.name
+            cmd += ' call do#MarkHistoryWindowAsClosed()'
+            vim.command(cmd)
+
+        self.command('setlocal syntax=do_output')
+
+
+class StatsWindow(Window):
+    name = "DoStats"
+
+    def on_create(self):
+        if self.creation_count == 1:
+            cmd = 'silent! au BufWinLeave %s' % self.name
+            cmd += ' call do#MarkStatsWindowAsClosed()'
+            vim.command(cmd)
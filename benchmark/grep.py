@@ -0,0 +1,113 @@
+""" Measure searching the output of past runs with :DoGrep.
+
+A history database is filled with runs of build-like output, each with a
+few warnings, and some with an error. It is then searched for patterns
+that match in every run, in a few runs, and in none, and for a pattern
+that the trigram index can't narrow down, which searches every run.
+
+Every pattern's results are then checked against a scan of every run, so
+that the index is known never to leave out a run that matches. Exits with
+status 1 if they differ.
+
+Usage: python benchmark/grep.py [runs] [lines per run]
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+class StandInOutput:
+    """ Output lines, in the form that the history writer reads them """
+    def __init__(self, lines):
+        self.__lines = lines
+
+    def __len__(self):
+        return len(self.__lines)
+
+    def lines(self):
+        return self.__lines
+
+def run_output(run, count):
+    lines = []
+    for i in range(count):
+        if i % 50 == 0:
+            lines.append("E> src/module_%i.c:%i:5: warning: unused variable "
+                    "'tmp_%i'" %(i, run % 300, i))
+        else:
+            lines.append("gcc -O2 -c src/module_%i.c -o build/module_%i.o"
+                    %(i, i))
+    if run % 100 == 0:
+        lines.append("E> src/main.c:12:1: error: expected ';' before "
+                "'return_value_%i'" % run)
+    if run % 7 == 0:
+        lines.append("padding: " + "x" * 150)
+    return lines
+
+patterns = ["unused variable", "error: expected", "return_value_1\\b",
+        "no_such_identifier", "E> src/m.in\\.c", "[0-9]+:1:", "x{100}",
+        "x{2,300}$", "module_1{2}\\.c", "tmp_\\d{3}'", "^padding",
+        "(unused|expected) ", "return_value_\\d{3}'"]
+
+def check(store, runs, count):
+    """ The patterns whose results differ from a scan of every run """
+    regexes = [re.compile(pattern) for pattern in patterns]
+    expected = [set() for _ in patterns]
+    for run in range(runs):
+        for (number, line) in enumerate(run_output(run, count)):
+            for (i, regex) in enumerate(regexes):
+                if regex.search(line):
+                    expected[i].add(("make module_%i" % run, number + 1))
+    wrong = []
+    for (i, pattern) in enumerate(patterns):
+        found = set((run.command, number)
+                for (run, number, _) in store.grep(pattern, runs * count))
+        if found != expected[i]:
+            wrong.append(pattern)
+    return wrong
+
+def main(args):
+    sys.path.insert(0, here)
+    sys.path.insert(0, os.path.join(here, "..", "autoload", "python"))
+    import vim
+    from history import HistoryStore
+
+    runs = int(args[0]) if len(args) > 0 else 2000
+    count = int(args[1]) if len(args) > 1 else 500
+    directory = tempfile.mkdtemp(prefix="vim-do-history-")
+    try:
+        path = os.path.join(directory, "history.db")
+        store = HistoryStore(path)
+        started = time.time()
+        for run in range(runs):
+            store.record("make module_%i" % run, "/tmp", "0", run, 1000,
+                    StandInOutput(run_output(run, count)))
+        store.stop()
+        print("Recorded %i runs of %i lines in %.2fs (%.1fMB)" %(runs, count,
+            time.time() - started, os.path.getsize(path) / 1048576.0))
+
+        store = HistoryStore(path)
+        print("%-36s %10s %10s" %("pattern", "ms", "results"))
+        for pattern in patterns:
+            started = time.time()
+            results = store.grep(pattern)
+            print("%-36s %10.1f %10i" %(pattern,
+                (time.time() - started) * 1000, len(results)))
+
+        wrong = check(store, runs, count)
+        store.stop()
+        if wrong:
+            print("Results differ from a scan of every run for: %s"
+                    % ", ".join(wrong))
+            return 1
+        print("Results match a scan of every run")
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,98 @@
+""" Measure the memory used to store process output.
+
+A million lines of compiler-like output, with one in ten lines on stderr,
+are added to an Output in batches, as check_now() would add them, with the
+memory limits turned off so that every line stays in memory. The same
+lines are also added to a ListOutput, which stores them the way Output
+did before it kept them as bytes, for comparison. The memory allocated by
+Python is measured with tracemalloc, so Python 3.4 or later is needed.
+
+Usage: python benchmark/memory.py [lines]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import array
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+class ListOutput:
+    """ Output as it was stored before: a string per line, where each
+    stderr line is a new copy with the "E> " prefix, and an index of the
+    line numbers of stderr lines """
+    def __init__(self):
+        self.__lines = []
+        self.__stderr = array.array('L')
+
+    def extend(self, lines, stderr = ()):
+        first = len(self.__lines)
+        lines = list(lines)
+        for (offset, count) in stderr:
+            self.__stderr.extend(range(first + offset, first + offset + count))
+            lines[offset:offset + count] = ["E> " + line
+                    for line in lines[offset:offset + count]]
+        self.__lines.extend(lines)
+
+    def lines(self, start, end):
+        return self.__lines[start:end]
+
+def batches(count, batch):
+    """ Lines and their stderr runs, as check_now() would add them """
+    for first in range(0, count, batch):
+        lines = []
+        stderr = []
+        for i in range(first, min(first + batch, count)):
+            if i % 10 == 0:
+                stderr.append((len(lines), 1))
+                lines.append("warning: something went wrong at step %i" % i)
+            else:
+                lines.append("compiling src/module_%i.c" % i)
+        yield (lines, stderr)
+
+def measure(tracemalloc, output, count):
+    """ Fill output, returning (bytes used, seconds to add the lines,
+    seconds to read them back) """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.time()
+    for (lines, stderr) in batches(count, 1000):
+        output.extend(lines, stderr)
+    extend_time = time.time() - started
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    started = time.time()
+    for first in range(0, count, 5000):
+        output.lines(first, first + 5000)
+    return (used, extend_time, time.time() - started)
+
+def main(args):
+    try:
+        import tracemalloc
+    except ImportError:
+        print("This benchmark needs tracemalloc, from Python 3.4")
+        return 1
+
+    sys.path.insert(0, here)
+    sys.path.insert(0, os.path.join(here, "..", "autoload", "python"))
+    import vim
+    vim.options["do_output_memory_lines"] = "0"
+    vim.options["do_output_memory_bytes"] = "0"
+    from output import Output
+
+    count = int(args[0]) if args else 1000000
+    print("%i lines" % count)
+    print("%-12s %10s %14s %10s %10s" %("storage", "MB", "bytes/line",
+        "read s", "add s"))
+    for (name, storage) in (("str list", ListOutput), ("Output", Output)):
+        (used, extend_time, read_time) = measure(tracemalloc, storage(),
+                count)
+        print("%-12s %10.1f %14.1f %10.2f %10.2f" %(name, used / 1048576.0,
+            float(used) / count, read_time, extend_time))
+    print("Reading is 5000 lines at a time. Adding is slowed down by "
+            "tracemalloc.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+""" Measure looking up processes with a long history of finished ones.
+
+A ProcessCollection is filled with 10,000 finished processes and a few
+running ones, and the lookups made on every check are timed: finding a
+process by pid, whether all processes have finished, and getting the
+running processes. They are compared against the scans over every process
+that the collection used to make.
+
+Usage: python benchmark/processes.py [finished] [running]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def timed(function, repeat):
+    """ The mean time of a call to function, in microseconds """
+    started = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - started) * 1000000 / repeat
+
+def main(args):
+    sys.path.insert(0, here)
+    sys.path.insert(0, os.path.join(here, "..", "autoload", "python"))
+    import vim
+    vim.options["do_keep_finished"] = "0"
+    from do import ProcessCollection
+
+    finished = int(args[0]) if len(args) > 0 else 10000
+    running = int(args[1]) if len(args) > 1 else 10
+    processes = ProcessCollection()
+    everything = []
+    for pid in range(1, finished + running + 1):
+        process = processes.add("true")
+        processes.mark_as_started(process, pid, True)
+        if pid <= finished:
+            processes.update(pid, 0, [])
+        everything.append(process)
+    last_pid = finished + running
+
+    # The scans that were made before processes were indexed
+    def scan_by_pid():
+        return next((p for p in everything if p.get_pid() == last_pid), None)
+
+    def scan_all_finished():
+        return len([p for p in everything if p.is_running()]) == 0
+
+    def scan_running():
+        return [p for p in everything if p.is_running()]
+
+    repeat = 1000
+    print("%i finished and %i running processes" %(finished, running))
+    print("%-16s %12s %12s" %("operation", "scan (us)", "index (us)"))
+    for (name, scan, index) in [
+            ("get_by_pid", scan_by_pid,
+                lambda: processes.get_by_pid(last_pid)),
+            ("all_finished", scan_all_finished, processes.all_finished),
+            ("get_running", scan_running, processes.get_running)]:
+        print("%-16s %12.2f %12.2f" %(name, timed(scan, repeat),
+            timed(index, repeat)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+""" Measure how fast compiler output is parsed into quickfix entries.
+
+Lines of gcc-style output (commands, warnings and errors with their source
+excerpts) are matched against Vim's default errorformat on Unix. The
+formats are matched joined into alternations, as ErrorFormat does, and
+one regex per format, for comparison. The time taken by
+QuickfixParser.parse(), which also reads the lines from an Output, is
+reported too.
+
+Usage: python benchmark/quickfix.py [lines]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Vim's default 'errorformat' on Unix
+default_errorformat = "%*[^\"]\"%f\"%*\\D%l: %m,\"%f\"%*\\D%l: %m," \
+    "%-G%f:%l: (Each undeclared identifier is reported only once," \
+    "%-G%f:%l: for each function it appears in.)," \
+    "%-GIn file included from %f:%l:%c:,%-GIn file included from %f:%l:%c\\,," \
+    "%-GIn file included from %f:%l:%c,%-GIn file included from %f:%l," \
+    "%-G%*[ ]from %f:%l:%c,%-G%*[ ]from %f:%l:,%-G%*[ ]from %f:%l\\,," \
+    "%-G%*[ ]from %f:%l,%f:%l:%c:%m,%f(%l):%m,%f:%l:%m," \
+    "\"%f\"\\, line %l%*\\D%c%*[^ ] %m," \
+    "%D%*\\a[%*\\d]: Entering directory %*[`']%f'," \
+    "%X%*\\a[%*\\d]: Leaving directory %*[`']%f'," \
+    "%D%*\\a: Entering directory %*[`']%f'," \
+    "%X%*\\a: Leaving directory %*[`']%f',%DMaking %*\\a in %f,%f|%l| %m"
+
+def gcc_output(count):
+    """ Lines like those of a C build, with a warning or error every few
+    files """
+    lines = []
+    i = 0
+    while len(lines) < count:
+        name = "src/module_%i.c" % i
+        lines.append("gcc -O2 -Wall -c %s -o build/module_%i.o" %(name, i))
+        if i % 3 == 0:
+            lines.extend([
+                "%s: In function 'run_%i':" %(name, i),
+                "%s:%i:%i: warning: unused variable 'x' "
+                    "[-Wunused-variable]" %(name, i % 500 + 1, i % 40 + 1),
+                "  %4i |     int x;" %(i % 500 + 1),
+                "       |         ^"])
+        if i % 10 == 0:
+            lines.extend([
+                "%s:%i:%i: error: 'y' undeclared (first use in this "
+                    "function)" %(name, i % 300 + 1, i % 20 + 1),
+                "  %4i |     return y;" %(i % 300 + 1),
+                "       |            ^"])
+        i += 1
+    return lines[:count]
+
+def timed(function):
+    started = time.time()
+    result = function()
+    return (time.time() - started, result)
+
+def main(args):
+    sys.path.insert(0, here)
+    sys.path.insert(0, os.path.join(here, "..", "autoload", "python"))
+    import vim
+    from quickfix import ErrorFormat, QuickfixParser
+    from output import Output
+
+    class SeparateErrorFormat(ErrorFormat):
+        """ Every format in a regex of its own """
+        max_groups = 0
+
+    count = int(args[0]) if args else 100000
+    lines = gcc_output(count)
+
+    def match_all(errorformat):
+        match = errorformat.match
+        return sum(1 for line in lines if match(line) is not None)
+
+    class StandInProcess:
+        def __init__(self):
+            self.__output = Output()
+            self.__output.extend(lines)
+
+        def output(self):
+            return self.__output
+
+        def has_finished(self):
+            return True
+
+    def parse():
+        parser = QuickfixParser(StandInProcess(), default_errorformat)
+        return len(parser.parse(time.time() + 3600))
+
+    print("%i lines of gcc output" % count)
+    print("%-28s %10s %12s %10s" %("", "seconds", "lines/s", "entries"))
+    for (name, function) in [
+            ("joined formats", lambda: match_all(
+                ErrorFormat(default_errorformat))),
+            ("one regex per format", lambda: match_all(
+                SeparateErrorFormat(default_errorformat))),
+            ("QuickfixParser.parse()", parse)]:
+        (elapsed, entries) = timed(function)
+        print("%-28s %10.3f %12i %10i" %(name, elapsed, count / elapsed,
+            entries))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+""" Compare the output reader against the one it replaced.
+
+The old reader (the first version of vim-do) ran a thread per process that
+waited on select() and then called readline(), putting each line on the
+queue on its own. The current reader is the select backend's
+AsyncProcessReader, which reads pipes in non-blocking chunks and queues a
+batch of lines per process per wakeup. For each command, this reports the
+lines read per second, and how many queue operations it took. The old
+reader stops once the process has exited, so it loses whatever is still in
+the pipes, which shows in its line count.
+
+Usage: python benchmark/reader.py [lines]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import select
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def commands(count):
+    return [
+        ("short lines", "seq 1 %i" % count),
+        ("mixed stderr", "awk 'BEGIN { for (i = 0; i < %i; i++) "
+            "{ print i; print i > \"/dev/stderr\" } }'" %(count // 2)),
+        ("long lines", "awk 'BEGIN { s = sprintf(\"%%400s\", \"\"); "
+            "gsub(/ /, \"x\", s); for (i = 0; i < %i; i++) print s }'"
+            %(count // 10)),
+    ]
+
+def old_reader(cmd, output_q):
+    """ The reader thread of the first version of vim-do """
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    pid = process.pid
+    fds = [process.stdout.fileno(), process.stderr.fileno()]
+    streams = [process.stdout, process.stderr]
+    while process.poll() is None:
+        fdsin, _, _ = select.select(fds, [], [])
+        for fd in fdsin:
+            output = [None, None]
+            ind = fds.index(fd)
+            s = streams[ind].readline()
+            if len(s) > 0:
+                output[ind] = s
+                output_q.put_nowait((pid, None, output[0], output[1]))
+    process.wait()
+    output_q.put_nowait((pid, process.returncode, None, None))
+
+def run_old(cmd):
+    output_q = queue.Queue(0)
+    thread = threading.Thread(target=old_reader, args=(cmd, output_q))
+    thread.start()
+    lines = 0
+    operations = 0
+    while True:
+        (pid, exit_code, stdout, stderr) = output_q.get()
+        operations += 1
+        if exit_code is not None:
+            break
+        lines += 1
+    thread.join()
+    return (lines, operations)
+
+def run_new(cmd):
+    import pool
+    process_pool = pool.ProcessPool()
+    process_pool.execute(cmd)
+    lines = 0
+    operations = 0
+    exited = False
+    while not exited:
+        for (pid, exit_code, stdout, stderr) in process_pool.get_outputs():
+            operations += 1
+            lines += len(stdout or ()) + len(stderr or ())
+            exited = exited or exit_code is not None
+        time.sleep(0.01)
+    process_pool.stop()
+    return (lines, operations)
+
+def main(args):
+    sys.path.insert(0, here)
+    sys.path.insert(0, os.path.join(here, "..", "autoload", "python"))
+    import vim
+    # Take output off the queue as fast as it arrives, without a limit
+    vim.options["do_queue_lines"] = "0"
+
+    count = int(args[0]) if args else 1000000
+    print("%-14s %-8s %10s %12s %12s" %("command", "reader", "lines",
+        "lines/s", "queue ops"))
+    for (name, cmd) in commands(count):
+        for (reader, run) in (("old", run_old), ("new", run_new)):
+            started = time.time()
+            (lines, operations) = run(cmd)
+            elapsed = time.time() - started
+            print("%-14s %-8s %10i %12i %12i" %(name, reader, lines,
+                lines / elapsed, operations))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
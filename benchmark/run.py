@@ -0,0 +1,212 @@
+""" Benchmark vim-do outside Vim, with synthetic workloads.
+
+Each workload is run in its own Python process, against the stand-in vim
+module in this directory, so that its peak memory use can be measured.
+The processes are driven the same way as Vim's timer drives them: tick()
+is called after each interval that Do asks for, until it stops the timer.
+
+Usage: python benchmark/run.py [--json FILE] [--backend NAME ...]
+                               [--option NAME=VALUE ...] [workload ...]
+
+Giving --backend more than once runs every workload with each backend,
+for a head-to-head comparison. --option overrides one of the g:do_
+options, e.g. --option do_backpressure=drop.
+
+The tick columns are the time taken by each call to tick(), including
+rendering, which is how long Vim is kept busy: this is the editor's
+responsiveness. The line latency columns are only filled in for some
+workloads. For the latency workload, they are the time from the command
+writing a line to the line appearing in the process window. The
+"concurrency" group of workloads (noisy_1 to noisy_64) runs 1 to 64 noisy
+processes at once, and its line latency is the time from a command writing
+a timestamp to it being read into vim-do, over every process. The flood
+workload writes as fast as it can for 5 seconds, to show the effect of
+g:do_queue_lines and g:do_backpressure on memory use.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import resource
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Each workload is a list of (command, quiet). The output of the first
+# command that isn't quiet is shown in the process window.
+workloads = {
+    "many_processes": [("seq 1 2000", True)] * 50,
+    "huge_output": [("seq 1 2000000", False)],
+    "long_lines": [("awk 'BEGIN { s = sprintf(\"%4000s\", \"\"); "
+        "gsub(/ /, \"x\", s); for (i = 0; i < 20000; i++) print s }'",
+        False)],
+    "mixed_stderr": [("awk 'BEGIN { for (i = 0; i < 200000; i++) "
+        "{ print i; print i > \"/dev/stderr\" } }'", False)],
+    "latency": [("i=0; while [ $i -lt 100 ]; do date +%s.%N; sleep 0.03; "
+        "i=$((i + 1)); done", False)],
+    "flood": [("timeout 5 yes 'the quick brown fox jumps over the lazy dog'",
+        True)],
+}
+order = ["many_processes", "huge_output", "long_lines", "mixed_stderr",
+        "latency", "flood"]
+
+# The concurrency sweep runs N noisy processes at once, for N from 1 to 64.
+# Each writes a timestamp, then a burst of other lines, every 30ms.
+noisy = ("i=0; while [ $i -lt 100 ]; do date +%s.%N; seq 1 500; sleep 0.03; "
+        "i=$((i + 1)); done")
+sweep = [1, 2, 4, 8, 16, 32, 64]
+for n in sweep:
+    workloads["noisy_%i" % n] = [(noisy, False)] + [(noisy, True)] * (n - 1)
+groups = {"concurrency": ["noisy_%i" % n for n in sweep]}
+# Options for particular workloads: the sweep runs every process at once,
+# and keeps them all so that their lines can be counted
+workload_options = dict(("noisy_%i" % n, {"do_max_parallel": str(n),
+    "do_keep_finished": "0"}) for n in sweep)
+timestamp = re.compile(r"^\d+\.\d+$")
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def run_workload(name, backend, options, timeout = 300):
+    """ Run a workload in this process, returning its results as a dict """
+    sys.path.insert(0, here)
+    sys.path.insert(0, os.path.join(here, "..", "autoload", "python"))
+    import vim
+    vim.options.update(workload_options.get(name, {}))
+    vim.options.update(options)
+    vim.options["do_backend"] = backend
+    vim.jobs_available = backend == "job"
+    from do import Do
+
+    do = Do()
+    started = time.time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    processes = [do.execute(command, quiet) for (command, quiet)
+            in workloads[name]]
+
+    tick_times = []
+    latencies = []
+    rendered = 0
+    ingested = [0] * len(processes)
+    while vim.timer_running and time.time() - started < timeout:
+        vim.run_events(do)
+        tick_started = time.time()
+        do.tick()
+        tick_times.append((time.time() - tick_started) * 1000)
+        if name == "latency":
+            window = vim.buffer_by_name("DoProcess")
+            for line in window[rendered:]:
+                if timestamp.match(line):
+                    latencies.append((tick_started - float(line)) * 1000)
+            rendered = len(window)
+        elif name in groups["concurrency"]:
+            for (i, process) in enumerate(processes):
+                output = process.output()
+                for line in output.from_line(ingested[i]):
+                    if timestamp.match(line):
+                        latencies.append((tick_started - float(line)) * 1000)
+                ingested[i] = len(output)
+    elapsed = time.time() - started
+    used = resource.getrusage(resource.RUSAGE_SELF)
+
+    lines = sum(len(p.output()) for p in processes)
+    dropped = sum(p.get_throttle()[1] for p in processes)
+    window = vim.buffer_by_name("DoProcess")
+    do.stop()
+    return {
+        "workload": name,
+        "backend": backend,
+        "processes": len(processes),
+        "lines": lines,
+        "dropped_lines": dropped,
+        "rendered_lines": len(window) if window is not None else 0,
+        "seconds": round(elapsed, 3),
+        "cpu_seconds": round(used.ru_utime + used.ru_stime - usage.ru_utime
+            - usage.ru_stime, 3),
+        "lines_per_second": int(lines / elapsed),
+        "ticks": len(tick_times),
+        "tick_p50_ms": round(percentile(tick_times, 50), 2),
+        "tick_p95_ms": round(percentile(tick_times, 95), 2),
+        "tick_p99_ms": round(percentile(tick_times, 99), 2),
+        "tick_max_ms": round(max(tick_times or [0]), 2),
+        # Only measured by the latency and concurrency workloads
+        "line_latency_p50_ms": round(percentile(latencies, 50), 2)
+            if latencies else None,
+        "line_latency_p95_ms": round(percentile(latencies, 95), 2)
+            if latencies else None,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_memory_mb": round(resource.getrusage(resource.RUSAGE_SELF)
+            .ru_maxrss / 1024.0, 1),
+        "timed_out": vim.timer_running,
+    }
+
+def run_in_subprocess(name, backend, options):
+    output = subprocess.check_output([sys.executable,
+        os.path.abspath(__file__), "--child", name, backend,
+        json.dumps(options)])
+    return json.loads(output.decode("utf-8"))
+
+def print_table(results):
+    columns = [("workload", "%-16s"), ("backend", "%-8s"), ("lines", "%10s"),
+            ("seconds", "%8s"), ("cpu_seconds", "%8s"),
+            ("lines_per_second", "%12s"),
+            ("ticks", "%6s"), ("tick_p50_ms", "%8s"), ("tick_p95_ms", "%8s"),
+            ("tick_p99_ms", "%8s"), ("tick_max_ms", "%8s"),
+            ("line_latency_p50_ms", "%9s"), ("line_latency_p95_ms", "%9s"),
+            ("peak_memory_mb", "%8s")]
+    headings = ["workload", "backend", "lines", "seconds", "cpu s", "lines/s",
+            "ticks", "p50 ms", "p95 ms", "p99 ms", "max ms", "line p50",
+            "line p95", "peak MB"]
+    print(" ".join(fmt % h for ((_, fmt), h) in zip(columns, headings)))
+    for result in results:
+        print(" ".join(fmt % ("-" if result[key] is None else result[key])
+            for (key, fmt) in columns))
+        if result["dropped_lines"]:
+            print("  (%i lines dropped)" % result["dropped_lines"])
+        if result["timed_out"]:
+            print("  (timed out)")
+
+def main(args):
+    if args[:1] == ["--child"]:
+        print(json.dumps(run_workload(args[1], args[2],
+            json.loads(args[3]))))
+        return 0
+
+    json_file = None
+    backends = []
+    options = {}
+    while args[:1] in (["--json"], ["--backend"], ["--option"]):
+        if args[0] == "--json":
+            json_file = args[1]
+        elif args[0] == "--backend":
+            backends.append(args[1])
+        else:
+            (option, value) = args[1].split("=", 1)
+            options[option] = value
+        args = args[2:]
+    backends = backends or ["auto"]
+    names = []
+    for name in args or order:
+        names.extend(groups.get(name, [name]))
+    for name in names:
+        if name not in workloads:
+            print("Unknown workload '%s', choose from: %s"
+                    %(name, ", ".join(order + sorted(groups))))
+            return 1
+
+    results = [run_in_subprocess(name, backend, options) for name in names
+            for backend in backends]
+    print_table(results)
+    if json_file is not None:
+        with open(json_file, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+""" A stand-in for Vim's python module, for running vim-do outside Vim.
+
+Buffers are kept in memory, and options are read from the defaults in
+autoload/do.vim, with any overrides set in the options dict. Only the
+commands and expressions that vim-do uses are understood: every other
+command is recorded and ignored, and every other expression evaluates
+to "0".
+
+Vim's timer and job callbacks are emulated by run_events(), which plays
+the part of Vim's event loop: it delivers job events as they arrive, until
+the timer is due.
+"""
+import os
+import re
+import sys
+import time
+import itertools
+import threading
+import subprocess
+import glob as globmodule
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+defaults_file = os.path.join(os.path.dirname(__file__), "..", "autoload",
+        "do.vim")
+
+def read_defaults(path):
+    defaults = {}
+    with open(path) as f:
+        for line in f:
+            match = re.match(r'let s:(do_\w+) = "?(.*?)"?$', line.strip())
+            if match:
+                defaults[match.group(1)] = match.group(2)
+    return defaults
+
+options = read_defaults(defaults_file)
+commands = []
+timer_running = False
+timer_interval = 0
+timer_deadline = 0
+# Set to True to make job_start() available, for the job backend
+jobs_available = False
+job_events = queue.Queue()
+
+
+class Buffer(list):
+    def __init__(self, name, number):
+        list.__init__(self, [""])
+        self.name = name
+        self.number = number
+        self.valid = True
+
+    def append(self, lines, nr = None):
+        if isinstance(lines, list):
+            self.extend(lines)
+        else:
+            list.append(self, lines)
+
+
+class Window:
+    cursor = (1, 0)
+
+
+class current:
+    window = Window()
+
+
+buffers = {}
+buffer_numbers = {}
+next_buffer_number = itertools.count(1)
+
+def command(cmd):
+    global timer_running, timer_interval, timer_deadline
+    commands.append(cmd)
+    match = re.match(r"silent .*?(Do\w+)$", cmd)
+    if match and match.group(1) not in buffer_numbers:
+        number = next(next_buffer_number)
+        buffers[number] = Buffer(match.group(1), number)
+        buffer_numbers[match.group(1)] = number
+    match = re.match(r"bwipeout (\w+)", cmd)
+    if match and match.group(1) in buffer_numbers:
+        buffers.pop(buffer_numbers.pop(match.group(1))).valid = False
+    match = re.match(r"call do#StartTimer\((\d+)\)", cmd)
+    if match:
+        timer_running = True
+        timer_interval = int(match.group(1))
+        timer_deadline = time.time() + timer_interval / 1000.0
+    elif cmd == "call do#StopTimer()":
+        timer_running = False
+
+def eval(expr):
+    if expr == "do#options()":
+        return dict(options)
+    match = re.match(r"""do#get\(["'](\w+)["']\)""", expr)
+    if match:
+        return options[match.group(1)]
+    match = re.match(r"""(buffer_number|bufwinnr|buffer_exists)"""
+            r"""\(["'](\w+)["']\)""", expr)
+    if match:
+        number = buffer_numbers.get(match.group(2), -1)
+        if match.group(1) == "buffer_exists":
+            return "1" if number > 0 else "0"
+        return str(number)
+    match = re.match(r"glob\('(.*)', 0, 1\)", expr)
+    if match:
+        return globmodule.glob(match.group(1))
+    if expr == 'has("timers")':
+        return "1"
+    if expr == 'exists("*job_start") || exists("*jobstart")':
+        return "1" if jobs_available else "0"
+    match = re.match(r"do#JobStart\('(.*)'\)$", expr, re.S)
+    if match:
+        return str(start_job(match.group(1).replace("''", "'")))
+    if expr == "&errorformat":
+        return "%f:%l:%c:%m,%f:%l:%m"
+    if expr in ("winnr()", "&winminheight"):
+        return "1"
+    return "0"
+
+def buffer_by_name(name):
+    number = buffer_numbers.get(name)
+    return buffers[number] if number is not None else None
+
+def start_job(cmd):
+    """ Start a process whose output is delivered as job events """
+    # Vim starts each job in a new session
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, preexec_fn=os.setsid)
+    readers = [threading.Thread(target=read_job, args=(process, index,
+        stream)) for (index, stream)
+        in enumerate([process.stdout, process.stderr])]
+    waiter = threading.Thread(target=wait_job, args=(process, readers))
+    for thread in readers + [waiter]:
+        thread.daemon = True
+        thread.start()
+    return process.pid
+
+def read_job(process, index, stream):
+    while True:
+        data = os.read(stream.fileno(), 65536)
+        if not data:
+            break
+        if sys.version_info[0] >= 3:
+            data = data.decode("utf-8", "replace")
+        job_events.put(("job_output", process.pid, index, data))
+
+def wait_job(process, readers):
+    exit_code = process.wait()
+    job_events.put(("job_exited", process.pid, exit_code))
+    for reader in readers:
+        reader.join()
+    job_events.put(("job_closed", process.pid))
+
+def run_events(do):
+    """ Deliver job events to do until the timer is due """
+    while True:
+        timeout = timer_deadline - time.time()
+        if timeout <= 0:
+            return
+        try:
+            event = job_events.get(timeout=timeout)
+        except queue.Empty:
+            return
+        getattr(do, event[0])(*event[1:])
@@ -14,14 +14,21 @@
 "=============================================================================
 " }}}
 
-if !has("python")
+if !has("python3") && !has("python")
     finish
 endif
 
 command! -nargs=* Do call do#Execute(<q-args>)
 command! -nargs=* DoQuietly call do#Execute(<q-args>, 1)
+command! -nargs=+ DoTimeout call do#ExecuteWithTimeout(<q-args>)
 command! -range DoThis call do#ExecuteSelection()
 command! DoAgain call do#ExecuteAgain()
+command! DoCacheStats call do#ShowCacheStats()
+command! -nargs=? DoHistory call do#ShowHistory(<q-args>)
+command! -nargs=1 DoGrep call do#GrepHistory(<q-args>)
+command! -nargs=? DoFilter call do#Filter(<q-args>)
+command! DoStats call do#ShowStats()
+command! -nargs=1 -complete=file DoStatsExport call do#ExportStats(<q-args>)
 command! Doing call do#ToggleCommandWindow()
 command! Done call do#ToggleCommandWindow()
 